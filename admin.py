@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Администрирование базы: потоковый импорт и экспорт пользователей, лайков и просмотров.
+
+    python admin.py export users users.jsonl
+    python admin.py export likes likes.csv
+    python admin.py export seen - --format jsonl | gzip > seen.jsonl.gz
+    python admin.py import users users.csv --chunk 5000
+    python admin.py import likes likes.jsonl --db /data/bot.db
+
+Формат берётся из расширения (.jsonl или .csv) или из --format. Пользователи связываются
+по tg_id, а не по внутреннему id, поэтому выгрузку можно загрузить в другую базу;
+импортировать сначала users, потом likes и seen. Импорт пишет пачками по --chunk строк —
+одна транзакция и executemany на пачку, в памяти только текущая пачка. Строки с ошибками
+(возраст вне AGE_MIN–AGE_MAX, неизвестный интерес, нет tg_id) пропускаются и печатаются
+в stderr, код выхода тогда 1.
+
+Бот можно не останавливать (WAL), но его кэш профилей увидит импорт только через
+PROFILE_CACHE_TTL, а колоды импортированных пользователей пересоберутся при следующем показе.
+"""
+
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from contextlib import nullcontext
+from itertools import islice
+
+import db
+from db import AGE_MAX, AGE_MIN, INTEREST_BITS
+
+# Колонки CSV и ключи JSONL; списки в CSV — через запятую в одной ячейке
+FIELDS = {
+    "users": ("tg_id", "name", "age", "faculty", "course", "photo_file_id", "interests"),
+    "likes": ("user_tg_id", "liked_tg_id"),
+    "seen": ("tg_id", "seen", "last_shown"),
+}
+LIST_FIELDS = {"interests", "seen"}
+FORMATS = ("jsonl", "csv")
+CHUNK = 1000
+# Сколько ошибочных строк печатать подробно
+SHOW_ERRORS = 20
+
+class Progress:
+    """Печатает в stderr число обработанных строк не чаще раза в секунду."""
+
+    def __init__(self, label: str):
+        self.label = label
+        self.rows = 0
+        self.started = self._printed = time.monotonic()
+
+    def add(self, rows: int):
+        self.rows += rows
+        if time.monotonic() - self._printed >= 1.0:
+            self._printed = time.monotonic()
+            print(f"{self.label}: {self.rows} строк ({self.rate():.0f} в секунду)", file=sys.stderr)
+
+    def rate(self) -> float:
+        return self.rows / max(time.monotonic() - self.started, 1e-9)
+
+    def done(self, extra: str = ""):
+        print(f"{self.label}: готово, {self.rows} строк за {time.monotonic() - self.started:.1f} с "
+              f"({self.rate():.0f} в секунду){extra}", file=sys.stderr)
+
+# === Чтение и запись строк ===
+def detect_format(path: str, fmt: str = None) -> str:
+    if fmt:
+        return fmt
+    ext = os.path.splitext(path)[1].lstrip(".").lower()
+    if ext in FORMATS:
+        return ext
+    raise SystemExit(f"Не удалось определить формат {path!r}: укажи --format {'/'.join(FORMATS)}")
+
+def open_stream(path: str, mode: str):
+    if path == "-":
+        return nullcontext(sys.stdin if mode == "r" else sys.stdout)
+    return open(path, mode, newline="", encoding="utf-8")
+
+def read_rows(stream, fmt: str, entity: str):
+    """Отдаёт (номер строки, dict или текст ошибки) по одной строке файла."""
+    if fmt == "csv":
+        reader = csv.DictReader(stream)
+        missing = set(FIELDS[entity]) - set(reader.fieldnames or ())
+        if missing:
+            raise SystemExit(f"В CSV нет колонок: {', '.join(sorted(missing))}")
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_no, line in enumerate(stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except json.JSONDecodeError as e:
+            yield line_no, f"некорректный JSON: {e}"
+            continue
+        yield line_no, row if isinstance(row, dict) else "ожидается JSON-объект"
+
+class RowWriter:
+    def __init__(self, stream, fmt: str, entity: str):
+        self.stream = stream
+        self.fmt = fmt
+        if fmt == "csv":
+            self._csv = csv.DictWriter(stream, FIELDS[entity])
+            self._csv.writeheader()
+
+    def write(self, row: dict):
+        if self.fmt == "csv":
+            self._csv.writerow({k: ",".join(map(str, v)) if k in LIST_FIELDS else v for k, v in row.items()})
+        else:
+            self.stream.write(json.dumps(row, ensure_ascii=False) + "\n")
+
+# === Проверка строк ===
+def parse_int(value, field: str) -> int:
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().lstrip("-").isdigit():
+        return int(value)
+    raise ValueError(f"{field}: ожидается целое число, получено {value!r}")
+
+def parse_list(value) -> list:
+    if value is None or value == "":
+        return []
+    if isinstance(value, list):
+        return value
+    if isinstance(value, str):
+        return [item.strip() for item in value.split(",") if item.strip()]
+    raise ValueError(f"ожидается список, получено {value!r}")
+
+def parse_user(row: dict) -> tuple:
+    tg_id = parse_int(row.get("tg_id"), "tg_id")
+    age = parse_int(row.get("age"), "age")
+    if not AGE_MIN <= age <= AGE_MAX:
+        raise ValueError(f"age: {age} вне диапазона {AGE_MIN}–{AGE_MAX}")
+    interests = [str(name).strip() for name in parse_list(row.get("interests"))]
+    unknown = [name for name in interests if name not in INTEREST_BITS]
+    if unknown:
+        raise ValueError(f"interests: неизвестные интересы {', '.join(unknown)}")
+    course = str(row.get("course") or "").strip()
+    if course and not course.isdigit():
+        raise ValueError(f"course: ожидается номер курса, получено {course!r}")
+    return (tg_id, str(row.get("name") or "").strip(), age, str(row.get("faculty") or "").strip(),
+            course, str(row.get("photo_file_id") or ""), db.interests_to_mask(interests))
+
+def parse_like(row: dict) -> tuple:
+    return parse_int(row.get("user_tg_id"), "user_tg_id"), parse_int(row.get("liked_tg_id"), "liked_tg_id")
+
+def parse_seen(row: dict) -> tuple:
+    seen = [parse_int(tg_id, "seen") for tg_id in parse_list(row.get("seen"))]
+    last_shown = row.get("last_shown")
+    return (parse_int(row.get("tg_id"), "tg_id"), seen,
+            parse_int(last_shown, "last_shown") if last_shown not in (None, "") else None)
+
+PARSERS = {"users": parse_user, "likes": parse_like, "seen": parse_seen}
+
+class Rejects:
+    def __init__(self):
+        self.count = 0
+
+    def add(self, line_no: int, error: str):
+        self.count += 1
+        if self.count <= SHOW_ERRORS:
+            print(f"строка {line_no}: {error}", file=sys.stderr)
+
+def valid_rows(rows, entity: str, rejects: Rejects):
+    parse = PARSERS[entity]
+    for line_no, row in rows:
+        if isinstance(row, str):
+            rejects.add(line_no, row)
+            continue
+        try:
+            yield parse(row)
+        except ValueError as e:
+            rejects.add(line_no, str(e))
+
+def chunks(rows, size: int):
+    rows = iter(rows)
+    while True:
+        chunk = list(islice(rows, size))
+        if not chunk:
+            return
+        yield chunk
+
+# === Импорт ===
+SQL_IMPORT_USER = """
+    INSERT INTO users (tg_id, name, age, faculty, faculty_id, course, photo_file_id, interests_mask)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (tg_id) DO UPDATE SET
+        name = excluded.name, age = excluded.age, faculty = excluded.faculty, faculty_id = excluded.faculty_id,
+        course = excluded.course, photo_file_id = excluded.photo_file_id, interests_mask = excluded.interests_mask
+"""
+SQL_CHUNK_USERS = "SELECT id, interests_mask FROM users WHERE tg_id IN (SELECT value FROM json_each(?))"
+SQL_DELETE_INTERESTS = """
+    DELETE FROM user_interests
+    WHERE interest_id IN (SELECT value FROM json_each(?)) AND user_id IN (SELECT value FROM json_each(?))
+"""
+SQL_IMPORT_LIKE = """
+    INSERT OR IGNORE INTO likes (user_id, liked_user_id)
+    SELECT a.id, b.id FROM users a, users b WHERE a.tg_id = ? AND b.tg_id = ?
+"""
+SQL_IDS_BY_TG = "SELECT u.id FROM json_each(?) j JOIN users u ON u.tg_id = j.value ORDER BY u.id"
+SQL_ID_BY_TG = "SELECT id FROM users WHERE tg_id = ?"
+
+def import_users(chunk: list, faculty_ids: dict) -> int:
+    with db.transaction() as cur:
+        rows = []
+        for tg_id, name, age, faculty, course, photo_file_id, mask in chunk:
+            # Факультетов немного: id запоминаются на весь импорт
+            key = db.faculty_key(faculty)
+            if key not in faculty_ids:
+                faculty_ids[key] = db.faculty_id_for(cur, faculty)
+            rows.append((tg_id, name, age, faculty, faculty_ids[key], course, photo_file_id, mask))
+        cur.executemany(SQL_IMPORT_USER, rows)
+        tg_ids = json.dumps([row[0] for row in chunk])
+        imported = cur.execute(SQL_CHUNK_USERS, (tg_ids,)).fetchall()
+        user_ids = json.dumps([user_id for user_id, _ in imported])
+        # Перебор по всем interest_id держит удаление на первичном ключе user_interests
+        cur.execute(SQL_DELETE_INTERESTS, (json.dumps(list(range(len(db.INTERESTS)))), user_ids))
+        cur.executemany("INSERT INTO user_interests (interest_id, user_id) VALUES (?, ?)",
+                        [(i, user_id) for user_id, mask in imported for i in db.mask_to_ids(mask)])
+        # Оценки в колодах устарели: свои колоды пересоберутся, в чужие пользователи попадут при пополнении
+        cur.execute("DELETE FROM candidate_deck WHERE user_id IN (SELECT value FROM json_each(?))", (user_ids,))
+        cur.execute("DELETE FROM candidate_deck WHERE candidate_id IN (SELECT value FROM json_each(?))", (user_ids,))
+    return len(chunk)
+
+def import_likes(chunk: list, _) -> int:
+    with db.transaction() as cur:
+        cur.executemany(SQL_IMPORT_LIKE, chunk)
+        return cur.rowcount
+
+def import_seen(chunk: list, _) -> int:
+    now = time.time()
+    written = 0
+    with db.transaction() as cur:
+        for tg_id, seen, last_shown in chunk:
+            row = cur.execute(SQL_ID_BY_TG, (tg_id,)).fetchone()
+            if not row:
+                continue
+            user_id = row[0]
+            shown_ids = [r[0] for r in cur.execute(SQL_IDS_BY_TG, (json.dumps(seen),))]
+            last = cur.execute(SQL_ID_BY_TG, (last_shown,)).fetchone() if last_shown is not None else None
+            epoch_started, current, previous, old_last = db.load_seen(cur, user_id, now)
+            merged = sorted(set(current).union(shown_ids))
+            db.save_seen(cur, user_id, epoch_started, db.pack_ids(merged), db.pack_ids(previous),
+                         last[0] if last else old_last)
+            written += 1
+    return written
+
+IMPORTERS = {"users": import_users, "likes": import_likes, "seen": import_seen}
+
+def run_import(entity: str, path: str, fmt: str, chunk_size: int) -> int:
+    rejects = Rejects()
+    progress = Progress(f"import {entity}")
+    written = 0
+    state = {}
+    with open_stream(path, "r") as stream:
+        for chunk in chunks(valid_rows(read_rows(stream, fmt, entity), entity, rejects), chunk_size):
+            written += IMPORTERS[entity](chunk, state)
+            progress.add(len(chunk))
+    if entity == "likes":
+        with db.transaction() as cur:
+            cur.execute(db.SQL_BACKFILL_MATCHES, (time.time(),))
+            print(f"Новых совпадений: {cur.rowcount}", file=sys.stderr)
+    skipped = progress.rows - written
+    progress.done(f", записано {written}" + (f", пропущено {skipped} (нет пользователя или уже есть)" if skipped else "")
+                  + (f", отклонено {rejects.count}" if rejects.count else ""))
+    return 1 if rejects.count else 0
+
+# === Экспорт ===
+SQL_EXPORT = {
+    "users": "SELECT tg_id, name, age, faculty, course, photo_file_id, interests_mask FROM users ORDER BY id",
+    "likes": """
+        SELECT a.tg_id, b.tg_id
+        FROM likes l
+        JOIN users a ON a.id = l.user_id
+        JOIN users b ON b.id = l.liked_user_id
+        ORDER BY l.id
+    """,
+    "seen": """
+        SELECT u.tg_id, s.current, s.previous, s.last_shown
+        FROM seen s
+        JOIN users u ON u.id = s.user_id
+        ORDER BY s.user_id
+    """,
+}
+SQL_TG_BY_IDS = "SELECT u.tg_id FROM json_each(?) j JOIN users u ON u.id = j.value ORDER BY u.tg_id"
+SQL_TG_BY_ID = "SELECT tg_id FROM users WHERE id = ?"
+
+def export_row(entity: str, row: tuple, lookup) -> dict:
+    if entity == "users":
+        tg_id, name, age, faculty, course, photo_file_id, mask = row
+        return {"tg_id": tg_id, "name": name, "age": age, "faculty": faculty, "course": course,
+                "photo_file_id": photo_file_id, "interests": db.mask_to_interests(mask)}
+    if entity == "likes":
+        return dict(zip(FIELDS["likes"], row))
+    tg_id, current, previous, last_shown = row
+    # Эпохи не переносятся: при импорте весь список попадает в текущую
+    ids = sorted(set(db.unpack_ids(current)).union(db.unpack_ids(previous)))
+    seen = [r[0] for r in lookup.execute(SQL_TG_BY_IDS, (json.dumps(ids),))]
+    last = lookup.execute(SQL_TG_BY_ID, (last_shown,)).fetchone() if last_shown is not None else None
+    return {"tg_id": tg_id, "seen": seen, "last_shown": last[0] if last else None}
+
+def run_export(entity: str, path: str, fmt: str, chunk_size: int) -> int:
+    conn = db.get_db_connection()
+    # Одна читающая транзакция: выгрузка — согласованный снимок, даже если бот пишет в базу
+    conn.execute("BEGIN")
+    progress = Progress(f"export {entity}")
+    try:
+        cur, lookup = conn.cursor(), conn.cursor()
+        cur.execute(SQL_EXPORT[entity])
+        with open_stream(path, "w") as stream:
+            writer = RowWriter(stream, fmt, entity)
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+                for row in rows:
+                    writer.write(export_row(entity, row, lookup))
+                progress.add(len(rows))
+    finally:
+        conn.rollback()
+    progress.done()
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Импорт и экспорт данных UniFriends55")
+    parser.add_argument("command", choices=("import", "export"))
+    parser.add_argument("entity", choices=tuple(FIELDS))
+    parser.add_argument("path", help="файл .jsonl или .csv; «-» — stdin/stdout (тогда нужен --format)")
+    parser.add_argument("--format", choices=FORMATS)
+    parser.add_argument("--db", default=db.DB_PATH, help="путь к базе (по умолчанию DB_PATH)")
+    parser.add_argument("--chunk", type=int, default=CHUNK, help="строк в одной транзакции")
+    args = parser.parse_args()
+    if args.chunk < 1:
+        parser.error("--chunk должен быть не меньше 1")
+
+    db.DB_PATH = args.db
+    db.init_db()
+    fmt = detect_format(args.path, args.format)
+    run = run_import if args.command == "import" else run_export
+    try:
+        sys.exit(run(args.entity, args.path, fmt, args.chunk))
+    finally:
+        db.close_connections()
+
+if __name__ == "__main__":
+    main()
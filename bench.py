@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Офлайн-бенчмарк хендлеров на синтетической популяции.
+
+Создаёт базу через миграции db и заполняет её --users пользователями с реалистичным
+распределением интересов (популярные интересы встречаются чаще), затем прогоняет через
+настоящие хендлеры bot.py регистрацию новых пользователей, /find и лайки/пропуски.
+Вместо Telegram запросы принимает FakeTelegram (synthetic.py) — он только запоминает вызовы,
+а время и SQL-выражения каждого обновления снимает MetricsMiddleware бота.
+
+По каждому хендлеру печатает p50/p99 задержки и число SQL-запросов на обновление,
+а также рост размера базы. Результат дописывается строкой в --out и сравнивается
+с предыдущим прогоном с теми же параметрами, чтобы регрессии было видно между версиями.
+
+    python bench.py --users 1000
+    python bench.py --users 1000000 --label after-index
+
+Заполненная база кэшируется в --data-dir и для каждого прогона копируется заново.
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+from collections import defaultdict
+
+from synthetic import FACULTIES, FakeTelegram, Updates, percentile, registration, swiping
+
+BENCH_TOKEN = "123456:BENCH"
+SEED_CHUNK = 10000
+# Telegram id синтетических пользователей: заполненные при посеве и зарегистрированные во время прогона
+SEED_TG_BASE = 10 ** 9
+NEW_TG_BASE = 2 * 10 ** 9
+
+# Сколько интересов выбирает пользователь: 1 -> 15%, 2 -> 25%, ...
+INTEREST_COUNT_WEIGHTS = {1: 15, 2: 25, 3: 25, 4: 18, 5: 10, 6: 7}
+
+def interest_weights(rng: random.Random, count: int) -> list:
+    # Популярность интересов по Ципфу: самый популярный примерно в count раз чаще самого редкого
+    ranks = list(range(1, count + 1))
+    rng.shuffle(ranks)
+    return [1.0 / r for r in ranks]
+
+def sample_interest_ids(rng: random.Random, weights: list) -> list:
+    k = rng.choices(list(INTEREST_COUNT_WEIGHTS), weights=list(INTEREST_COUNT_WEIGHTS.values()))[0]
+    chosen = set()
+    while len(chosen) < k:
+        chosen.add(rng.choices(range(len(weights)), weights=weights)[0])
+    return sorted(chosen)
+
+# === Посев ===
+def seed(path: str, users: int, seed_value: int):
+    import db
+
+    rng = random.Random(seed_value)
+    weights = interest_weights(rng, len(db.INTERESTS))
+    conn = db.connect(path)
+    cur = conn.cursor()
+    db.migrate(cur)
+    cur.execute("BEGIN IMMEDIATE")
+    faculty_ids = {name: db.faculty_id_for(cur, name) for name in FACULTIES}
+    cur.execute("COMMIT")
+    for start in range(0, users, SEED_CHUNK):
+        rows, interests = [], []
+        for i in range(start, min(start + SEED_CHUNK, users)):
+            ids = sample_interest_ids(rng, weights)
+            mask = sum(1 << bit for bit in ids)
+            faculty = rng.choice(FACULTIES)
+            rows.append((i + 1, SEED_TG_BASE + i, f"Студент {i}", rng.randint(17, 25), faculty, faculty_ids[faculty],
+                         str(rng.randint(1, 4)), f"photo-{i}", mask))
+            interests += [(i + 1, bit) for bit in ids]
+        cur.execute("BEGIN IMMEDIATE")
+        cur.executemany("INSERT INTO users (id, tg_id, name, age, faculty, faculty_id, course, photo_file_id, interests_mask) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        cur.executemany("INSERT INTO user_interests (user_id, interest_id) VALUES (?, ?)", interests)
+        cur.execute("COMMIT")
+    cur.execute("ANALYZE")
+    cur.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+    conn.close()
+    return weights
+
+def db_size(path: str) -> int:
+    return sum(os.path.getsize(p) for p in (path, path + "-wal") if os.path.exists(p))
+
+async def run(args, path: str, weights: list) -> dict:
+    import bot as app
+    from aiogram import Bot, Dispatcher, types
+    from db import INTERESTS
+
+    # Хендлер, время и число SQL-выражений каждого обновления берём у MetricsMiddleware бота
+    finished = []
+    app.metrics_middleware.listeners.append(finished.append)
+    api = FakeTelegram()
+    app.bot.request = api.request
+    Bot.set_current(app.bot)
+    Dispatcher.set_current(app.dp)
+    await app.on_startup(app.dp)
+
+    rng = random.Random(args.seed + 1)
+    updates = Updates()
+
+    def choose_interests(rng):
+        return [INTERESTS[i] for i in sample_interest_ids(rng, weights)]
+
+    def swipes(tg_id):
+        return swiping(updates, rng, api.cards, tg_id, args.swipes, actions=("like", "like", "skip"))
+
+    scripts = [registration(updates, rng, NEW_TG_BASE + i, choose_interests) + swipes(NEW_TG_BASE + i)
+               for i in range(args.registrations)]
+    swipers = rng.sample(range(args.users), min(args.swipers, args.users))
+    scripts += [swipes(SEED_TG_BASE + i) for i in swipers]
+    rng.shuffle(scripts)
+
+    latencies = defaultdict(list)
+    query_counts = defaultdict(list)
+    size_before = db_size(path)
+    started = time.perf_counter()
+    # Обновления идут по одному: так задержка и число запросов относятся ровно к одному хендлеру
+    for update in itertools.chain.from_iterable(scripts):
+        if callable(update):
+            update = update()
+        await asyncio.create_task(app.dp.updates_handler.notify(types.Update(**update)))
+        timer = finished.pop()
+        latencies[timer.handler or "unhandled"].append(timer.seconds)
+        query_counts[timer.handler or "unhandled"].append(timer.queries.statements)
+    elapsed = time.perf_counter() - started
+
+    await app.db.writes.flush()
+    await app.dp.storage.flush()
+    size_after = db_size(path)
+    await app.on_shutdown(app.dp)
+
+    total = sum(len(v) for v in latencies.values())
+    return {
+        "updates": total,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(total / elapsed, 1) if elapsed else 0.0,
+        "handlers": {name: {"count": len(values),
+                            "p50_ms": round(percentile(values, 0.5) * 1000, 3),
+                            "p99_ms": round(percentile(values, 0.99) * 1000, 3),
+                            "queries_per_update": round(sum(query_counts[name]) / len(values), 2)}
+                     for name, values in sorted(latencies.items())},
+        "db_bytes_before": size_before,
+        "db_bytes_after": size_after,
+        "db_bytes_per_update": round((size_after - size_before) / total, 1) if total else 0.0,
+        "api_calls": dict(api.calls),
+    }
+
+# === Результаты ===
+def git_label() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "local"
+
+def load_previous(path: str, params: dict):
+    previous = None
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                entry = json.loads(line)
+                if entry.get("params") == params:
+                    previous = entry
+    return previous
+
+def report(result: dict, previous: dict = None):
+    print(f"Обновлений: {result['updates']} за {result['elapsed_s']} с ({result['updates_per_s']} в секунду)")
+    print(f"{'хендлер':<22}{'n':>7}{'p50, мс':>11}{'p99, мс':>11}{'SQL/обн':>9}")
+    for name, h in result["handlers"].items():
+        line = f"{name:<22}{h['count']:>7}{h['p50_ms']:>11.2f}{h['p99_ms']:>11.2f}{h['queries_per_update']:>9.1f}"
+        old = (previous or {}).get("result", {}).get("handlers", {}).get(name)
+        if old:
+            line += "   p50 {:+.0%}  p99 {:+.0%}  SQL {:+.1f}".format(
+                h["p50_ms"] / old["p50_ms"] - 1 if old["p50_ms"] else 0.0,
+                h["p99_ms"] / old["p99_ms"] - 1 if old["p99_ms"] else 0.0,
+                h["queries_per_update"] - old["queries_per_update"])
+        print(line)
+    print(f"База: {result['db_bytes_before'] / 2 ** 20:.1f} -> {result['db_bytes_after'] / 2 ** 20:.1f} МБ "
+          f"({result['db_bytes_per_update']} байт на обновление)")
+    print(f"Вызовы Bot API: {result['api_calls']}")
+    if previous:
+        print(f"Сравнение с прогоном {previous['label']} от {previous['at']}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк хендлеров UniFriends55")
+    parser.add_argument("--users", type=int, default=1000, help="размер синтетической популяции")
+    parser.add_argument("--registrations", type=int, default=100, help="сколько новых пользователей регистрируется")
+    parser.add_argument("--swipers", type=int, default=100, help="сколько существующих пользователей листают анкеты")
+    parser.add_argument("--swipes", type=int, default=20, help="лайков/пропусков на пользователя")
+    parser.add_argument("--seed", type=int, default=55)
+    parser.add_argument("--data-dir", default="bench_data", help="где хранить заполненные базы")
+    parser.add_argument("--out", default="bench_results.jsonl", help="куда дописывать результаты")
+    parser.add_argument("--label", default=None, help="метка прогона (по умолчанию — текущий коммит)")
+    args = parser.parse_args()
+
+    os.makedirs(args.data_dir, exist_ok=True)
+    path = os.path.join(args.data_dir, "run.db")
+    # db и bot читают настройки из окружения при импорте
+    os.environ["DB_PATH"] = path
+    os.environ.setdefault("BOT_TOKEN", BENCH_TOKEN)
+    # Свайпы идут быстрее живых и по одному message_id: без лимитов частоты и склейки повторов
+    os.environ.setdefault("THROTTLE_LIMITS", "")
+    os.environ.setdefault("THROTTLE_DEDUP_WINDOW", "0")
+    base = os.path.join(args.data_dir, f"seed-{args.users}-{args.seed}.db")
+    rng = random.Random(args.seed)
+    if not os.path.exists(base):
+        print(f"Заполняю базу: {args.users} пользователей...")
+        t0 = time.perf_counter()
+        seed(base + ".tmp", args.users, args.seed)
+        os.replace(base + ".tmp", base)
+        print(f"Готово за {time.perf_counter() - t0:.1f} с")
+    from db import INTERESTS
+    # Те же веса, что и при посеве: генератор посева начинается с них
+    weights = interest_weights(rng, len(INTERESTS))
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    shutil.copyfile(base, path)
+
+    result = asyncio.run(run(args, path, weights))
+    params = {"users": args.users, "registrations": args.registrations, "swipers": args.swipers,
+              "swipes": args.swipes, "seed": args.seed}
+    previous = load_previous(args.out, params)
+    report(result, previous)
+    with open(args.out, "a", encoding="utf-8") as f:
+        f.write(json.dumps({"label": args.label or git_label(), "at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                            "python": sys.version.split()[0], "params": params, "result": result},
+                           ensure_ascii=False) + "\n")
+
+if __name__ == "__main__":
+    main()
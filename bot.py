@@ -7,48 +7,87 @@ UniFriends55 - Telegram бот для знакомств по интересам
 Не забудь указать переменную окружения BOT_TOKEN в Railway.
 """
 
+import asyncio
+import functools
 import logging
-import sqlite3
 import os
-from typing import List
 
-from aiogram import Bot, Dispatcher, executor, types
+from aiogram import Dispatcher, executor, types
+from aiogram.bot.api import TELEGRAM_PRODUCTION, TelegramAPIServer
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
+from aiohttp import web
+
+import metrics
+import workers
+from db import AGE_MAX, AGE_MIN, INTERESTS, db, interests_to_mask, mask_to_interests, profile_cache
+from metrics import MetricsMiddleware, SlowUpdateProfiler, registry
+from sender import OUTBOX_GLOBAL_RATE, MarkupCoalescer, QueuedBot
+from storage import SQLiteStorage
+from throttling import ThrottlingMiddleware
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 BOT_TOKEN = os.environ.get("BOT_TOKEN") or "ВАШ_ТОКЕН_ЗДЕСЬ"
-
-bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(bot, storage=MemoryStorage())
-
-DB_PATH = os.environ.get("DB_PATH", "bot.db")
-
-# Список интересов, адаптированный под студентов Финансового университета Омска
-INTERESTS = [
-    "Воллейбол",
-    "Футбол",
-    "Баскетбол",
-    "Музыка",
-    "IT",
-    "Бизнес",
-    "Путешествия",
-    "Искусство",
-    "Самообразование",
-    "Языки",
-    "Финансы",
-    "Кино",
-    "Игры",
-    "Кофейни",
-    "Психология",
-    "Фитнес"
-]
+# Адрес Bot API; переопределяется для локального тестового стенда (webhook_harness.py)
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL")
+
+# Режим запуска: polling (по умолчанию) или webhook
+RUN_MODE = os.environ.get("RUN_MODE", "polling")
+# Публичный адрес, на который Telegram будет слать обновления, например https://unifriends55.up.railway.app
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "")
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET", "")
+# Сколько одновременных запросов с обновлениями Telegram может держать открытыми
+WEBHOOK_MAX_CONNECTIONS = int(os.environ.get("WEBHOOK_MAX_CONNECTIONS", "40"))
+WEBAPP_HOST = os.environ.get("WEBAPP_HOST", "0.0.0.0")
+WEBAPP_PORT = int(os.environ.get("PORT", "8080"))
+# Число процессов-обработчиков; при WORKERS > 1 обновления раскладываются по ним (см. workers.py)
+WORKERS = int(os.environ.get("WORKERS", "1"))
+MATCHES_PAGE_SIZE = 10
+
+bot = QueuedBot(token=BOT_TOKEN, server=TelegramAPIServer.from_base(TELEGRAM_API_URL) if TELEGRAM_API_URL else TELEGRAM_PRODUCTION)
+dp = Dispatcher(bot, storage=SQLiteStorage())
+# Частые нажатия на интересы превращаются в одну правку клавиатуры
+interest_edits = MarkupCoalescer(bot)
+
+# Замер хендлеров, базы и Bot API (см. metrics.py)
+metrics_middleware = MetricsMiddleware()
+dp.middleware.setup(metrics_middleware)
+dp.register_errors_handler(metrics_middleware.on_error)
+slow_profiler = SlowUpdateProfiler() if metrics.PROFILE_SLOW_UPDATES else None
+if slow_profiler:
+    metrics_middleware.listeners.append(slow_profiler)
+# Лимиты на частые команды и нажатия (см. throttling.py); выбор интересов — переключатель, его повтор не дубль
+throttling = ThrottlingMiddleware(repeatable=("toggle_interest",))
+dp.middleware.setup(throttling)
+
+def collect_gauges() -> dict:
+    outbox = bot.outbox.stats()
+    cache = profile_cache.stats()
+    fsm = dp.storage.stats()
+    return {
+        "outbox_queued_interactive": outbox["queued"]["interactive"],
+        "outbox_queued_notification": outbox["queued"]["notification"],
+        "outbox_pending": outbox["pending"],
+        "outbox_sent": outbox["sent"],
+        "outbox_failed": outbox["failed"],
+        "outbox_retry_after": outbox["retry_after"],
+        "profile_cache_size": cache["size"],
+        "profile_cache_hit_ratio": cache["hit_ratio"],
+        "fsm_hot": fsm["hot"],
+        "fsm_dirty": fsm["dirty"],
+        "write_buffer_pending": db.writes.stats()["pending"],
+        "interest_edits_coalesced": interest_edits.coalesced,
+        "throttle_in_flight": throttling.stats()["in_flight"],
+    }
 
 # Состояния регистрации
+class SettingsStates(StatesGroup):
+    age = State()
+
 class RegStates(StatesGroup):
     name = State()
     age = State()
@@ -57,142 +96,6 @@ class RegStates(StatesGroup):
     photo = State()
     interests = State()
 
-# === База данных ===
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        tg_id INTEGER UNIQUE,
-        name TEXT,
-        age INTEGER,
-        faculty TEXT,
-        course TEXT,
-        photo_file_id TEXT,
-        interests TEXT
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS likes (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        liked_user_id INTEGER,
-        UNIQUE(user_id, liked_user_id)
-    )
-    """)
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS shown (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        shown_user_id INTEGER,
-        UNIQUE(user_id, shown_user_id)
-    )
-    """)
-    conn.commit()
-    conn.close()
-
-def get_db_connection():
-    return sqlite3.connect(DB_PATH)
-
-# === Утилиты работы с БД ===
-def upsert_user(tg_id: int, name: str = None, age: int = None, faculty: str = None, course: str = None, photo_file_id: str = None, interests: List[str] = None):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT tg_id FROM users WHERE tg_id = ?", (tg_id,))
-    existing = cur.fetchone()
-    if existing:
-        fields = []
-        params = []
-        if name is not None:
-            fields.append("name = ?"); params.append(name)
-        if age is not None:
-            fields.append("age = ?"); params.append(age)
-        if faculty is not None:
-            fields.append("faculty = ?"); params.append(faculty)
-        if course is not None:
-            fields.append("course = ?"); params.append(course)
-        if photo_file_id is not None:
-            fields.append("photo_file_id = ?"); params.append(photo_file_id)
-        if interests is not None:
-            fields.append("interests = ?"); params.append(",".join(interests))
-        if fields:
-            sql = "UPDATE users SET " + ", ".join(fields) + " WHERE tg_id = ?"
-            params.append(tg_id)
-            cur.execute(sql, tuple(params))
-    else:
-        cur.execute("""
-            INSERT INTO users (tg_id, name, age, faculty, course, photo_file_id, interests)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (tg_id, name or "", age or 0, faculty or "", course or "", photo_file_id or "", ",".join(interests or [])))
-    conn.commit()
-    conn.close()
-
-def get_user_by_tg(tg_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, tg_id, name, age, faculty, course, photo_file_id, interests FROM users WHERE tg_id = ?", (tg_id,))
-    row = cur.fetchone()
-    conn.close()
-    if not row:
-        return None
-    id_, tg_id, name, age, faculty, course, photo_file_id, interests = row
-    interests_list = interests.split(",") if interests else []
-    return {"id": id_, "tg_id": tg_id, "name": name, "age": age, "faculty": faculty, "course": course, "photo_file_id": photo_file_id, "interests": interests_list}
-
-def get_all_other_users(tg_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, tg_id, name, age, faculty, course, photo_file_id, interests FROM users WHERE tg_id != ?", (tg_id,))
-    rows = cur.fetchall()
-    conn.close()
-    users = []
-    for r in rows:
-        id_, tg, name, age, faculty, course, photo_file_id, interests = r
-        interests_list = interests.split(",") if interests else []
-        users.append({"id": id_, "tg_id": tg, "name": name, "age": age, "faculty": faculty, "course": course, "photo_file_id": photo_file_id, "interests": interests_list})
-    return users
-
-def mark_shown(user_id: int, shown_user_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute("INSERT INTO shown (user_id, shown_user_id) VALUES (?, ?)", (user_id, shown_user_id))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        pass
-    conn.close()
-
-def has_been_shown(user_id: int, shown_user_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM shown WHERE user_id = ? AND shown_user_id = ?", (user_id, shown_user_id))
-    r = cur.fetchone()
-    conn.close()
-    return bool(r)
-
-def add_like(user_id: int, liked_user_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    try:
-        cur.execute("INSERT INTO likes (user_id, liked_user_id) VALUES (?, ?)", (user_id, liked_user_id))
-        conn.commit()
-    except sqlite3.IntegrityError:
-        pass
-    conn.close()
-
-def check_mutual_like(user_id: int, liked_user_id: int):
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id FROM likes WHERE user_id = ? AND liked_user_id = ?", (liked_user_id, user_id))
-    r = cur.fetchone()
-    conn.close()
-    return bool(r)
-
-# Подсчёт совпадений интересов
-def common_interest_count(a: List[str], b: List[str]) -> int:
-    return len(set([x.strip().lower() for x in a if x]) & set([x.strip().lower() for x in b if x]))
-
 # === Keyboards ===
 def make_start_kb():
     kb = ReplyKeyboardMarkup(resize_keyboard=True)
@@ -200,8 +103,11 @@ def make_start_kb():
     kb.add(KeyboardButton("/settings"), KeyboardButton("/help"))
     return kb
 
-def make_interests_keyboard(selected: List[str] = None):
-    if selected is None: selected = []
+# Список INTERESTS неизменен, поэтому клавиатура однозначно задаётся маской выбранного
+# и строится один раз на каждое состояние выбора
+@functools.lru_cache(maxsize=1024)
+def make_interests_keyboard(mask: int = 0):
+    selected = mask_to_interests(mask)
     kb = InlineKeyboardMarkup(row_width=2)
     for interest in INTERESTS:
         text = ("✅ " if interest in selected else "") + interest
@@ -209,19 +115,18 @@ def make_interests_keyboard(selected: List[str] = None):
     kb.row(InlineKeyboardButton("Готово", callback_data="interests_done"))
     return kb
 
-def profile_action_kb():
+def profile_action_kb(candidate_id: int):
     kb = InlineKeyboardMarkup()
-    kb.add(InlineKeyboardButton("❤️ Нравится", callback_data="like"))
-    kb.add(InlineKeyboardButton("❌ Пропустить", callback_data="skip"))
-    kb.add(InlineKeyboardButton("Пожаловаться", callback_data="report"))
+    kb.add(InlineKeyboardButton("❤️ Нравится", callback_data=f"like||{candidate_id}"))
+    kb.add(InlineKeyboardButton("❌ Пропустить", callback_data=f"skip||{candidate_id}"))
+    kb.add(InlineKeyboardButton("Пожаловаться", callback_data=f"report||{candidate_id}"))
     return kb
 
 # === Хендлеры ===
 
 @dp.message_handler(commands=["start"])
 async def cmd_start(message: types.Message, state: FSMContext):
-    init_db()
-    user = get_user_by_tg(message.from_user.id)
+    user = await db.get_user_by_tg(message.from_user.id)
     if user is None or not user.get("name"):
         await message.answer(
             "Привет! Я UniFriends55 — бот для знакомств и поиска друзей по интересам внутри вашего университета.\nСначала пройдём короткую регистрацию.\nКак тебя зовут?",
@@ -248,8 +153,8 @@ async def reg_age_invalid(message: types.Message):
 @dp.message_handler(lambda m: m.text.isdigit(), state=RegStates.age)
 async def reg_age(message: types.Message, state: FSMContext):
     age = int(message.text.strip())
-    if age < 16 or age > 100:
-        await message.answer("Введи, пожалуйста, реальный возраст (16-100).")
+    if age < AGE_MIN or age > AGE_MAX:
+        await message.answer(f"Введи, пожалуйста, реальный возраст ({AGE_MIN}-{AGE_MAX}).")
         return
     await state.update_data(age=age)
     await message.answer("Укажи факультет (например: Финансовый факультет):")
@@ -278,7 +183,7 @@ async def reg_photo(message: types.Message, state: FSMContext):
     photo = message.photo[-1]
     file_id = photo.file_id
     await state.update_data(photo_file_id=file_id)
-    await message.answer("Отлично! Теперь выбери свои интересы. Нажимай, чтобы выбрать / снять. Нажми «Готово», когда закончишь.", reply_markup=make_interests_keyboard([]))
+    interest_edits.send(lambda: message.answer("Отлично! Теперь выбери свои интересы. Нажимай, чтобы выбрать / снять. Нажми «Готово», когда закончишь.", reply_markup=make_interests_keyboard(0)), key=0)
     await RegStates.interests.set()
 
 @dp.message_handler(lambda m: m.text, content_types=types.ContentTypes.ANY, state=RegStates.photo)
@@ -296,8 +201,9 @@ async def toggle_interest(callback: types.CallbackQuery, state: FSMContext):
     else:
         selected.append(interest)
     await state.update_data(interests=selected)
-    await callback.message.edit_reply_markup(reply_markup=make_interests_keyboard(selected))
     await callback.answer()
+    mask = interests_to_mask(selected)
+    interest_edits.update(callback.message.chat.id, callback.message.message_id, make_interests_keyboard(mask), key=mask)
 
 @dp.callback_query_handler(lambda c: c.data == "interests_done", state=RegStates.interests)
 async def interests_done(callback: types.CallbackQuery, state: FSMContext):
@@ -308,8 +214,9 @@ async def interests_done(callback: types.CallbackQuery, state: FSMContext):
     course = data.get("course")
     photo_file_id = data.get("photo_file_id")
     interests = data.get("interests", [])
+    interest_edits.cancel(callback.message.chat.id, callback.message.message_id)
     # записать в БД
-    upsert_user(callback.from_user.id, name=name, age=age, faculty=faculty, course=course, photo_file_id=photo_file_id, interests=interests)
+    await db.upsert_user(callback.from_user.id, name=name, age=age, faculty=faculty, course=course, photo_file_id=photo_file_id, interests=interests)
     await callback.message.answer("Регистрация завершена! Теперь используйте /find чтобы искать людей или /profile чтобы посмотреть свой профиль.", reply_markup=make_start_kb())
     await state.finish()
     await callback.answer("Сохранено ✅")
@@ -317,7 +224,7 @@ async def interests_done(callback: types.CallbackQuery, state: FSMContext):
 # /profile — показать свой профиль и кнопки редактирования
 @dp.message_handler(commands=["profile"])
 async def cmd_profile(message: types.Message):
-    user = get_user_by_tg(message.from_user.id)
+    user = await db.get_user_by_tg(message.from_user.id)
     if not user:
         await message.answer("Профиль не найден — пройди регистрацию через /start.")
         return
@@ -368,14 +275,15 @@ async def edit_photo_start(message: types.Message):
 @dp.message_handler(lambda m: m.text == "Изменить интересы")
 async def edit_interests_start(message: types.Message):
     state = dp.current_state(user=message.from_user.id)
-    await state.update_data(interests=get_user_by_tg(message.from_user.id).get("interests", []))
-    await message.answer("Выбирай интересы. Нажми «Готово», когда закончишь.", reply_markup=make_interests_keyboard(get_user_by_tg(message.from_user.id).get("interests", [])))
+    user = await db.get_user_by_tg(message.from_user.id)
+    await state.update_data(interests=list(user.get("interests", [])))
+    interest_edits.send(lambda: message.answer("Выбирай интересы. Нажми «Готово», когда закончишь.", reply_markup=make_interests_keyboard(user["interests_mask"])), key=user["interests_mask"])
     await RegStates.interests.set()
 
 # /find — начать показ профилей
 @dp.message_handler(commands=["find"])
 async def cmd_find(message: types.Message):
-    user = get_user_by_tg(message.from_user.id)
+    user = await db.get_user_by_tg(message.from_user.id)
     if not user or not user.get("interests"):
         await message.answer("Чтобы искать людей, нужно заполнить профиль с интересами. Запусти /start и пройди регистрацию.")
         return
@@ -383,81 +291,65 @@ async def cmd_find(message: types.Message):
     await show_next_candidate(message.chat.id, message.from_user.id)
 
 async def show_next_candidate(chat_id: int, tg_user_id: int):
-    me = get_user_by_tg(tg_user_id)
+    me = await db.get_user_by_tg(tg_user_id)
     if not me:
         await bot.send_message(chat_id, "Сначала пройдите регистрацию через /start.")
         return
-    candidates = get_all_other_users(tg_user_id)
-    scored = []
-    for c in candidates:
-        if has_been_shown(me['id'], c['id']):
-            continue
-        score = common_interest_count(me.get("interests", []), c.get("interests", []))
-        scored.append((score, c))
-    if not scored:
-        await bot.send_message(chat_id, "Больше нет новых профилей. Попробуй позже или увеличь круг интересов.")
+    picked = await db.pop_next_candidate(me)
+    if not picked:
+        await bot.send_message(chat_id, "Больше нет новых профилей. Попробуй позже, увеличь круг интересов или ослабь фильтры в /settings.")
         return
-    scored.sort(key=lambda x: x[0], reverse=True)
-    score, candidate = scored[0]
-    mark_shown(me['id'], candidate['id'])
+    score, candidate = picked
+    await db.mark_shown(me['id'], candidate['id'])
     text = f"👤 {candidate['name']}, {candidate['age']} лет\n{candidate['faculty']}\nКурс: {candidate.get('course', '')}\n\nИнтересы: {', '.join(candidate.get('interests', []))}\n\nСовпадений по интересам: {score}"
     if candidate.get("photo_file_id"):
-        await bot.send_photo(chat_id, candidate['photo_file_id'], caption=text, reply_markup=profile_action_kb())
+        await bot.send_photo(chat_id, candidate['photo_file_id'], caption=text, reply_markup=profile_action_kb(candidate['id']))
     else:
-        await bot.send_message(chat_id, text, reply_markup=profile_action_kb())
+        await bot.send_message(chat_id, text, reply_markup=profile_action_kb(candidate['id']))
 
-# Кнопки лайка/пропуска/жалобы
-@dp.callback_query_handler(lambda c: c.data in ["like", "skip", "report"])
+# Кнопки лайка/пропуска/жалобы; id кандидата приходит в callback_data,
+# поэтому действие относится именно к той карточке, на которой нажали кнопку
+@dp.callback_query_handler(lambda c: c.data and c.data.split("||", 1)[0] in ("like", "skip", "report"))
 async def profile_action(callback: types.CallbackQuery):
-    user = get_user_by_tg(callback.from_user.id)
+    user = await db.get_user_by_tg(callback.from_user.id)
     if not user:
         await callback.answer("Сначала пройди регистрацию через /start.")
         return
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT shown_user_id FROM shown WHERE user_id = ? ORDER BY id DESC LIMIT 1", (user['id'],))
-    row = cur.fetchone()
-    conn.close()
-    if not row:
+    action, _, candidate_id = callback.data.partition("||")
+    if candidate_id.isdigit():
+        candidate_id = int(candidate_id)
+    else:
+        # Карточки, отправленные до появления id в callback_data
+        candidate_id = await db.get_last_shown(user['id'])
+    if candidate_id is None:
         await callback.answer("Нет кандидатов для действия.")
         return
-    candidate_id = row[0]
-    conn = get_db_connection()
-    cur = conn.cursor()
-    cur.execute("SELECT id, tg_id, name, age, faculty, course, photo_file_id, interests FROM users WHERE id = ?", (candidate_id,))
-    r = cur.fetchone()
-    conn.close()
-    if not r:
+    cand = await db.get_user_by_id(candidate_id)
+    if not cand:
         await callback.answer("Кандидат не найден.")
         return
-    cand = {"id": r[0], "tg_id": r[1], "name": r[2], "age": r[3], "faculty": r[4], "course": r[5], "photo_file_id": r[6], "interests": r[7].split(",") if r[7] else []}
 
-    if callback.data == "skip":
+    if action == "skip":
         await callback.answer("Пропущено.")
         await show_next_candidate(callback.message.chat.id, callback.from_user.id)
         return
 
-    if callback.data == "report":
+    if action == "report":
         await callback.answer("Жалоба отправлена модераторам (симуляция).")
         await bot.send_message(callback.from_user.id, "Спасибо. Мы получим жалобу и рассмотрим пользователя.")
         return
 
-    if callback.data == "like":
-        add_like(user['id'], cand['id'])
-        if check_mutual_like(user['id'], cand['id']):
+    if action == "like":
+        if await db.record_like(user['id'], cand['id']):
             await callback.answer("Это взаимная симпатия! 🎉")
             link_to_candidate = f"tg://user?id={cand['tg_id']}"
             link_to_user = f"tg://user?id={user['tg_id']}"
             msg_to_user = f"У вас совпадение с {cand['name']} ({cand['age']} лет, {cand['faculty']}, курс {cand['course']}).\nНаписать: {link_to_candidate}\nИнтересы: {', '.join(cand['interests'])}"
             msg_to_cand = f"У вас совпадение с {user['name']} ({user['age']} лет, {user['faculty']}, курс {user['course']}).\nНаписать: {link_to_user}\nИнтересы: {', '.join(user['interests'])}"
-            try:
-                await bot.send_message(user['tg_id'], msg_to_user)
-            except Exception as e:
-                logger.exception("Ошибка отправки сообщения пользователю при совпадении: %s", e)
-            try:
-                await bot.send_message(cand['tg_id'], msg_to_cand)
-            except Exception as e:
-                logger.exception("Ошибка отправки сообщения кандидату при совпадении: %s", e)
+            # Уведомления о совпадении уходят в фоне, после ответов на действия пользователей;
+            # при флуд-контроле очередь повторит отправку сама
+            bot.notify(user['tg_id'], msg_to_user)
+            bot.notify(cand['tg_id'], msg_to_cand)
             await show_next_candidate(callback.message.chat.id, callback.from_user.id)
             return
         else:
@@ -465,12 +357,169 @@ async def profile_action(callback: types.CallbackQuery):
             await show_next_candidate(callback.message.chat.id, callback.from_user.id)
             return
 
-@dp.message_handler(commands=["help", "settings"])
+# /matches — список совпадений постранично
+def format_matches_page(matches: list, page: int):
+    has_next = len(matches) > MATCHES_PAGE_SIZE
+    matches = matches[:MATCHES_PAGE_SIZE]
+    if not matches:
+        return ("Пока нет совпадений. Ищи людей через /find." if page == 0 else "Больше совпадений нет."), None
+    lines = [f"Твои совпадения (страница {page + 1}):"]
+    for i, m in enumerate(matches, start=page * MATCHES_PAGE_SIZE + 1):
+        lines.append(f"{i}. {m['name']}, {m['age']} лет, {m['faculty']}, курс {m['course']} — tg://user?id={m['tg_id']}")
+    kb = InlineKeyboardMarkup(row_width=2)
+    if page > 0:
+        kb.insert(InlineKeyboardButton("◀️ Назад", callback_data=f"matches||{page - 1}"))
+    if has_next:
+        kb.insert(InlineKeyboardButton("Вперёд ▶️", callback_data=f"matches||{page + 1}"))
+    return "\n".join(lines), kb
+
+async def matches_page(tg_user_id: int, page: int):
+    user = await db.get_user_by_tg(tg_user_id)
+    if not user:
+        return "Сначала пройдите регистрацию через /start.", None
+    # На одну запись больше, чтобы знать, есть ли следующая страница
+    matches = await db.get_matches(user['id'], MATCHES_PAGE_SIZE + 1, page * MATCHES_PAGE_SIZE)
+    return format_matches_page(matches, page)
+
+@dp.message_handler(commands=["matches"])
+async def cmd_matches(message: types.Message):
+    text, kb = await matches_page(message.from_user.id, 0)
+    await message.answer(text, reply_markup=kb)
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("matches||"))
+async def matches_turn_page(callback: types.CallbackQuery):
+    page = callback.data.split("||", 1)[1]
+    text, kb = await matches_page(callback.from_user.id, int(page) if page.isdigit() else 0)
+    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
+
+# /settings — фильтры поиска по возрасту, факультету и курсу
+COURSES = ("1", "2", "3", "4", "5", "6")
+
+async def format_settings(filters: dict):
+    if filters.get("age_min") is not None or filters.get("age_max") is not None:
+        age = f"{filters.get('age_min') or AGE_MIN}–{filters.get('age_max') or AGE_MAX}"
+    else:
+        age = "любой"
+    faculty = await db.get_faculty_name(filters["faculty_id"]) if filters.get("faculty_id") is not None else None
+    text = (
+        "Фильтры поиска:\n"
+        f"Возраст: {age}\n"
+        f"Факультет: {faculty or 'любой'}\n"
+        f"Курс: {filters.get('course') or 'любой'}"
+    )
+    kb = InlineKeyboardMarkup(row_width=3)
+    kb.add(InlineKeyboardButton("Возраст", callback_data="settings||age"),
+           InlineKeyboardButton("Факультет", callback_data="settings||faculty"),
+           InlineKeyboardButton("Курс", callback_data="settings||course"))
+    kb.add(InlineKeyboardButton("Сбросить фильтры", callback_data="settings||reset"))
+    return text, kb
+
+def parse_age_range(text: str):
+    """«18-22», «18» или «-» (без ограничения) -> (age_min, age_max); None, если не разобрать."""
+    text = text.replace("–", "-").replace(" ", "")
+    if text == "-":
+        return None, None
+    low, sep, high = text.partition("-")
+    if not sep:
+        high = low
+    if not (low.isdigit() and high.isdigit()):
+        return None
+    low, high = int(low), int(high)
+    if not AGE_MIN <= low <= high <= AGE_MAX:
+        return None
+    return low, high
+
+@dp.message_handler(commands=["settings"])
+async def cmd_settings(message: types.Message):
+    user = await db.get_user_by_tg(message.from_user.id)
+    if not user:
+        await message.answer("Сначала пройдите регистрацию через /start.")
+        return
+    text, kb = await format_settings(await db.get_filters(user['id']))
+    await message.answer(text, reply_markup=kb)
+
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith("settings||"))
+async def settings_menu(callback: types.CallbackQuery):
+    user = await db.get_user_by_tg(callback.from_user.id)
+    if not user:
+        await callback.answer("Сначала пройди регистрацию через /start.")
+        return
+    choice = callback.data.split("||", 1)[1]
+    if choice == "age":
+        await callback.message.answer(f"Напиши диапазон возраста, например 18-22, или «-», чтобы искать без ограничения ({AGE_MIN}–{AGE_MAX}). "
+                                      "/cancel — оставить как есть.")
+        await SettingsStates.age.set()
+    elif choice == "faculty":
+        kb = InlineKeyboardMarkup(row_width=1)
+        for faculty_id, name in await db.list_faculties():
+            kb.add(InlineKeyboardButton(name, callback_data=f"set_faculty||{faculty_id}"))
+        kb.add(InlineKeyboardButton("Любой", callback_data="set_faculty||any"))
+        await callback.message.edit_reply_markup(reply_markup=kb)
+    elif choice == "course":
+        kb = InlineKeyboardMarkup(row_width=len(COURSES))
+        kb.add(*(InlineKeyboardButton(c, callback_data=f"set_course||{c}") for c in COURSES))
+        kb.add(InlineKeyboardButton("Любой", callback_data="set_course||any"))
+        await callback.message.edit_reply_markup(reply_markup=kb)
+    elif choice == "reset":
+        filters = await db.set_filters(user['id'], age_min=None, age_max=None, faculty_id=None, course=None)
+        text, kb = await format_settings(filters)
+        await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer()
+
+@dp.callback_query_handler(lambda c: c.data and c.data.split("||", 1)[0] in ("set_faculty", "set_course"))
+async def settings_choose(callback: types.CallbackQuery):
+    user = await db.get_user_by_tg(callback.from_user.id)
+    if not user:
+        await callback.answer("Сначала пройди регистрацию через /start.")
+        return
+    field, _, value = callback.data.partition("||")
+    if field == "set_faculty":
+        filters = await db.set_filters(user['id'], faculty_id=int(value) if value.isdigit() else None)
+    else:
+        filters = await db.set_filters(user['id'], course=value if value in COURSES else None)
+    text, kb = await format_settings(filters)
+    await callback.message.edit_text(text, reply_markup=kb)
+    await callback.answer("Фильтр сохранён.")
+
+# Любая команда во время ввода возраста отменяет ввод (фильтр не меняется);
+# кроме /cancel, она затем выполняется как обычно
+@dp.message_handler(commands=["cancel"], state=SettingsStates.age)
+async def settings_age_cancel(message: types.Message, state: FSMContext):
+    await state.finish()
+    await message.answer("Возраст оставлен как был.")
+
+# Другая команда выводит из ввода возраста; выполнить её сразу нельзя — её хендлер
+# ждёт пустое состояние, а это обновление уже прошло фильтры, поэтому просим повторить
+@dp.message_handler(lambda m: m.is_command(), state=SettingsStates.age)
+async def settings_age_command(message: types.Message, state: FSMContext):
+    await state.finish()
+    await message.answer(f"Возраст оставлен как был. Отправь {message.get_command()} ещё раз.")
+
+@dp.message_handler(lambda m: not m.is_command(), state=SettingsStates.age)
+async def settings_age(message: types.Message, state: FSMContext):
+    user = await db.get_user_by_tg(message.from_user.id)
+    if not user:
+        await state.finish()
+        await message.answer("Сначала пройдите регистрацию через /start.")
+        return
+    ages = parse_age_range(message.text or "")
+    if ages is None:
+        await message.answer(f"Не понял. Напиши диапазон от {AGE_MIN} до {AGE_MAX}, например 18-22, или «-».")
+        return
+    await state.finish()
+    filters = await db.set_filters(user['id'], age_min=ages[0], age_max=ages[1])
+    text, kb = await format_settings(filters)
+    await message.answer(text, reply_markup=kb)
+
+@dp.message_handler(commands=["help"])
 async def cmd_help(message: types.Message):
     text = (
         "Команды:\n"
         "/start — регистрация / начало\n"
         "/find — поиск людей по интересам\n"
+        "/matches — твои совпадения\n"
+        "/settings — фильтры поиска\n"
         "/profile — показать свой профиль\n"
         "/edit_profile — изменить профиль\n\n"
         "Советы:\n"
@@ -484,6 +533,100 @@ async def fallback(message: types.Message):
     await message.answer("Не понял. Используй /start, /find или /profile. Для помощи — /help.", reply_markup=make_start_kb())
 
 # === Запуск ===
+async def on_startup(dp: Dispatcher):
+    await db.init()
+    # Только в процессе, который обрабатывает обновления: у приёмника WORKERS > 1 свои метрики
+    registry.add_collector(collect_gauges)
+    if metrics.METRICS_DUMP_INTERVAL > 0:
+        dp["metrics_dump"] = asyncio.ensure_future(metrics.dump_loop())
+    # /metrics в режиме нескольких процессов отдаёт приёмник
+    if metrics.METRICS_PORT and RUN_MODE != "webhook" and "worker" not in dp:
+        dp["metrics_server"] = await metrics.start_server()
+    if slow_profiler:
+        slow_profiler.start()
+
+async def on_shutdown(dp: Dispatcher):
+    if "metrics_dump" in dp:
+        dp["metrics_dump"].cancel()
+    if "metrics_server" in dp:
+        await dp["metrics_server"].cleanup()
+    if slow_profiler:
+        slow_profiler.stop()
+    # Дослать то, что уже в очереди, пока сессия Bot API открыта
+    await bot.outbox.close()
+    logger.info("Очередь отправки: %s", bot.outbox.stats())
+    logger.info("Правки клавиатур интересов: %s", interest_edits.stats())
+    logger.info("Кэш профилей: %s", profile_cache.stats())
+    logger.info("Ограничение частоты: %s", throttling.stats())
+    # Сбросить отложенные показы и состояния FSM, пока пул соединений ещё работает
+    await db.writes.close()
+    logger.info("Буфер записей: %s", db.writes.stats())
+    await dp.storage.close()
+    db.close()
+
+async def on_startup_webhook(dp: Dispatcher):
+    if not WEBHOOK_HOST:
+        raise RuntimeError("Для RUN_MODE=webhook нужна переменная WEBHOOK_HOST")
+    await bot.set_webhook(WEBHOOK_HOST.rstrip("/") + WEBHOOK_PATH, max_connections=WEBHOOK_MAX_CONNECTIONS,
+                          secret_token=WEBHOOK_SECRET or None, drop_pending_updates=True)
+
+# Отклоняем запросы без секрета, который Telegram передаёт в заголовке (если он задан)
+@web.middleware
+async def check_webhook_secret(request: web.Request, handler):
+    if WEBHOOK_SECRET and request.path == WEBHOOK_PATH \
+            and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+        return web.Response(status=403)
+    return await handler(request)
+
+# Каждое обновление приходит отдельным HTTP-запросом и обрабатывается в своей задаче,
+# поэтому обновления разных пользователей идут параллельно, без цикла getUpdates.
+def run_webhook():
+    app = web.Application(middlewares=[check_webhook_secret])
+    metrics.setup_routes(app)
+    runner = executor.set_webhook(dp, WEBHOOK_PATH, web_app=app,
+                                  on_startup=[on_startup, on_startup_webhook], on_shutdown=on_shutdown)
+    runner.run_app(host=WEBAPP_HOST, port=WEBAPP_PORT)
+
+# === Несколько процессов (WORKERS > 1) ===
+# Этот процесс только принимает обновления и раскладывает их по обработчикам;
+# каждый обработчик — отдельный процесс с собственной копией dp, bot и пула базы.
+def run_worker(index: int, inbox, reports):
+    workers.serve(dp, index, inbox, reports, on_startup=on_startup, on_shutdown=on_shutdown)
+
+def run_workers():
+    # Лимит Bot API общий на бота, а очередь отправки у каждого процесса своя
+    os.environ["OUTBOX_GLOBAL_RATE"] = str(OUTBOX_GLOBAL_RATE / WORKERS)
+    front = workers.FrontEnd(run_worker, WORKERS)
+
+    async def start():
+        # Миграции до запуска обработчиков, чтобы они не ждали друг друга на блокировке
+        await db.init()
+        front.start()
+        if RUN_MODE == "webhook":
+            await on_startup_webhook(dp)
+        elif metrics.METRICS_PORT:
+            dp["metrics_server"] = await metrics.start_server()
+
+    async def stop():
+        if "metrics_server" in dp:
+            await dp["metrics_server"].cleanup()
+        await front.stop()
+        await (await bot.get_session()).close()
+        db.close()
+
+    logger.info("Запуск в %s процессах (%s)", WORKERS, RUN_MODE)
+    if RUN_MODE == "webhook":
+        app = workers.webhook_app(front, WEBHOOK_PATH, middlewares=[check_webhook_secret])
+        app.on_startup.append(lambda app: start())
+        app.on_shutdown.append(lambda app: stop())
+        web.run_app(app, host=WEBAPP_HOST, port=WEBAPP_PORT)
+    else:
+        workers.run_polling(bot, front, on_startup=start, on_shutdown=stop)
+
 if __name__ == "__main__":
-    init_db()
-    executor.start_polling(dp, skip_updates=True)
+    if WORKERS > 1:
+        run_workers()
+    elif RUN_MODE == "webhook":
+        run_webhook()
+    else:
+        executor.start_polling(dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown)
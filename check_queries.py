@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Проверка планов горячих запросов перед деплоем.
+
+Накатывает миграции на временную (или указанную) базу, прогоняет
+EXPLAIN QUERY PLAN для каждого запроса из HOT_QUERIES и завершается с кодом 1,
+если какой-то из них читает таблицу целиком (SCAN) там, где это не разрешено явно.
+
+    python check_queries.py            # на пустой временной базе
+    python check_queries.py bot.db     # на копии реальной базы
+"""
+
+import os
+import sys
+import tempfile
+
+import db
+
+INTEREST_IDS = (0, 4, 11)
+SEEN_JSON = "[2, 3, 5]"
+# Фильтрованный поиск: каждый набор фильтров должен читать только свой срез users
+FILTER_SETS = {
+    "faculty_course_age": {"faculty_id": 1, "course": "2", "age_min": 18, "age_max": 22},
+    "faculty_age": {"faculty_id": 1, "age_min": 18, "age_max": 22},
+    "course_age": {"course": "2", "age_min": 18, "age_max": 22},
+    "age": {"age_min": 18, "age_max": 22},
+}
+
+def rank_filtered(filters: dict):
+    where, params = db.filter_clause(filters)
+    return db.SQL_RANK_FILTERED.format(where=where), (1, *params, 1, SEEN_JSON, 50)
+
+# (название, SQL, параметры)
+HOT_QUERIES = [
+    ("user_by_tg", db.SQL_USER_BY_TG, (1,)),
+    ("user_by_id", db.SQL_USER_BY_ID, (1,)),
+    ("masks", db.SQL_MASKS, ()),
+    ("users_by_mask", db.SQL_USERS_BY_MASK, (0b10001, 0, 50)),
+    ("deck_top", db.SQL_DECK_TOP, (1,)),
+    *((f"rank_filtered_{name}", *rank_filtered(filters)) for name, filters in FILTER_SETS.items()),
+    ("filters", db.SQL_FILTERS, (1,)),
+    ("top_faculties", db.SQL_TOP_FACULTIES, (10,)),
+    ("idle_decks", db.SQL_IDLE_DECKS, (0, 100)),
+    ("seen", db.SQL_SEEN, (1,)),
+    ("last_shown", db.SQL_LAST_SHOWN, (1,)),
+    ("mutual_like", db.SQL_MUTUAL_LIKE, (2, 1)),
+    ("matches_page", db.SQL_MATCHES_PAGE, (1, 11, 0)),
+]
+
+# Запросы, которым разрешён полный проход по таблицам с указанными алиасами
+ALLOWED_SCANS = {
+    # Различных масок интересов не больше 2^len(INTERESTS), сколько бы ни было пользователей;
+    # читаются раз на пополнение колоды.
+    "masks": ("interest_masks",),
+}
+
+def explain(cur, sql, params):
+    return [row[3] for row in cur.execute("EXPLAIN QUERY PLAN " + sql, params)]
+
+def check(path: str) -> int:
+    conn = db.connect(path)
+    cur = conn.cursor()
+    db.migrate(cur)
+    failures = 0
+    for name, sql, params in HOT_QUERIES:
+        plan = explain(cur, sql, params)
+        # Старые версии SQLite пишут "SCAN TABLE x", новые — "SCAN x".
+        # Проход по json_each — это чтение списка-параметра (просмотренные анкеты), а не таблицы.
+        scans = [step.replace("SCAN TABLE ", "SCAN ") for step in plan
+                 if step.startswith("SCAN") and "VIRTUAL TABLE" not in step]
+        bad = [step for step in scans if step.split()[1] not in ALLOWED_SCANS.get(name, ())]
+        status = "FAIL" if bad else "ok"
+        failures += bool(bad)
+        print(f"[{status}] {name}")
+        for step in plan:
+            print(f"    {step}")
+    conn.close()
+    return failures
+
+def main():
+    if len(sys.argv) > 1:
+        failures = check(sys.argv[1])
+    else:
+        with tempfile.TemporaryDirectory() as tmp:
+            failures = check(os.path.join(tmp, "check.db"))
+    if failures:
+        print(f"Полный проход таблицы в {failures} запрос(ах) — нужен индекс.")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
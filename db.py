@@ -0,0 +1,1086 @@
+# coding: utf-8
+
+"""
+Слой доступа к данным UniFriends55 (SQLite).
+
+Соединения долгоживущие: у каждого потока пула своё, с включённым WAL.
+Синхронные функции ниже выполняются только в потоках пула; хендлеры бота
+вызывают их через асинхронный фасад `db`, поэтому запросы к SQLite
+не блокируют event loop.
+"""
+
+import asyncio
+import bisect
+import contextvars
+import functools
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import List
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.environ.get("DB_PATH", "bot.db")
+# Сколько потоков (и соединений) обслуживают запросы к базе
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "4"))
+# Сколько кандидатов ранжируется за раз в колоду пользователя
+DECK_BATCH = int(os.environ.get("DECK_BATCH", "50"))
+# Колода, которую не пополняли DECK_TTL_DAYS дней, удаляется; за одно пополнение
+# чужой колоды удаляется не больше DECK_PRUNE_BATCH устаревших
+DECK_TTL = float(os.environ.get("DECK_TTL_DAYS", "7")) * 24 * 3600
+DECK_PRUNE_BATCH = int(os.environ.get("DECK_PRUNE_BATCH", "100"))
+# Кэш профилей: максимум записей и время жизни записи в секундах
+PROFILE_CACHE_SIZE = int(os.environ.get("PROFILE_CACHE_SIZE", "10000"))
+PROFILE_CACHE_TTL = float(os.environ.get("PROFILE_CACHE_TTL", "300"))
+# Показы пишутся пачками: раз в WRITE_FLUSH_INTERVAL секунд или при WRITE_BATCH событиях
+# (лайки пишутся сразу, см. record_like)
+WRITE_FLUSH_INTERVAL = float(os.environ.get("WRITE_FLUSH_INTERVAL", "0.01"))
+WRITE_BATCH = int(os.environ.get("WRITE_BATCH", "200"))
+# Через сколько дней просмотренная анкета может показаться снова (от SEEN_EPOCH_DAYS до 2x)
+SEEN_EPOCH = float(os.environ.get("SEEN_EPOCH_DAYS", "30")) * 24 * 3600
+
+# Список интересов, адаптированный под студентов Финансового университета Омска
+INTERESTS = [
+    "Воллейбол",
+    "Футбол",
+    "Баскетбол",
+    "Музыка",
+    "IT",
+    "Бизнес",
+    "Путешествия",
+    "Искусство",
+    "Самообразование",
+    "Языки",
+    "Финансы",
+    "Кино",
+    "Игры",
+    "Кофейни",
+    "Психология",
+    "Фитнес"
+]
+
+# Интересы хранятся битовой маской: бит i соответствует INTERESTS[i].
+# Поэтому порядок списка менять нельзя — новые интересы добавляются только в конец.
+INTEREST_BITS = {name: i for i, name in enumerate(INTERESTS)}
+
+def interests_to_mask(interests: List[str]) -> int:
+    mask = 0
+    for name in interests or []:
+        bit = INTEREST_BITS.get(name.strip())
+        if bit is not None:
+            mask |= 1 << bit
+    return mask
+
+def mask_to_interests(mask: int) -> List[str]:
+    return [name for i, name in enumerate(INTERESTS) if mask >> i & 1]
+
+def mask_to_ids(mask: int) -> List[int]:
+    return [i for i in range(len(INTERESTS)) if mask >> i & 1]
+
+# Допустимый возраст (регистрация, фильтры поиска, импорт в admin.py)
+AGE_MIN, AGE_MAX = 16, 100
+
+# === Соединения ===
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",
+)
+
+class QueryStats:
+    """Сколько SQL-выражений и времени в базе потратило одно обновление (см. metrics.py)."""
+    __slots__ = ("statements", "calls", "seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.calls = 0
+        self.seconds = 0.0
+
+# Статистика текущего обновления; Database.run переносит контекст в поток пула
+query_stats = contextvars.ContextVar("query_stats", default=None)
+
+def _count_statement(statement: str):
+    stats = query_stats.get()
+    if stats is not None:
+        stats.statements += 1
+
+def connect(path: str = None) -> sqlite3.Connection:
+    # isolation_level=None: транзакции открываем сами (см. transaction), чтобы писатели
+    # сразу брали RESERVED-блокировку и не ловили SQLITE_BUSY при апгрейде чтения до записи.
+    conn = sqlite3.connect(path or DB_PATH, isolation_level=None, check_same_thread=False)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    conn.set_trace_callback(_count_statement)
+    return conn
+
+def get_db_connection() -> sqlite3.Connection:
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = connect()
+        with _connections_lock:
+            _connections.append(conn)
+    return conn
+
+def close_connections():
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+    _local.__dict__.clear()
+
+@contextmanager
+def transaction(mode: str = "IMMEDIATE"):
+    # DEFERRED — читающая транзакция: один снимок WAL на несколько запросов без блокировки записи
+    conn = get_db_connection()
+    conn.execute(f"BEGIN {mode}")
+    try:
+        yield conn.cursor()
+    except BaseException:
+        conn.rollback()
+        raise
+    else:
+        conn.commit()
+
+# === Схема и миграции ===
+# Каждая миграция выполняется ровно один раз; номер последней применённой хранится
+# в PRAGMA user_version. Новые миграции только дописываются в конец списка.
+# Первые шаги написаны через IF NOT EXISTS: базы, созданные до появления версий
+# (user_version = 0), проходят их без ошибок.
+
+def _migration_base(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tg_id INTEGER UNIQUE,
+        name TEXT,
+        age INTEGER,
+        faculty TEXT,
+        course TEXT,
+        photo_file_id TEXT,
+        interests TEXT
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS likes (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        liked_user_id INTEGER,
+        UNIQUE(user_id, liked_user_id)
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS shown (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER,
+        shown_user_id INTEGER,
+        UNIQUE(user_id, shown_user_id)
+    )
+    """)
+
+# Перевод старых строк "IT,Кино,..." в битовую маску и user_interests.
+# Текстовая колонка после переноса очищается.
+def _migration_interests_mask(cur):
+    columns = [r[1] for r in cur.execute("PRAGMA table_info(users)")]
+    if "interests_mask" not in columns:
+        cur.execute("ALTER TABLE users ADD COLUMN interests_mask INTEGER NOT NULL DEFAULT 0")
+    # Инвертированный индекс «интерес -> пользователи» для поиска людей хотя бы с одним общим интересом
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_interests (
+        interest_id INTEGER,
+        user_id INTEGER,
+        PRIMARY KEY (interest_id, user_id)
+    ) WITHOUT ROWID
+    """)
+    rows = cur.execute("SELECT id, interests FROM users WHERE interests IS NOT NULL AND interests != ''").fetchall()
+    for user_id, interests in rows:
+        mask = interests_to_mask(interests.split(","))
+        cur.execute("UPDATE users SET interests_mask = ?, interests = '' WHERE id = ?", (mask, user_id))
+        set_user_interests(cur, user_id, mask)
+
+def _migration_candidate_deck(cur):
+    # Колода: заранее отранжированные кандидаты для каждого пользователя
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS candidate_deck (
+        user_id INTEGER,
+        candidate_id INTEGER,
+        score INTEGER,
+        PRIMARY KEY (user_id, candidate_id)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_deck_order ON candidate_deck (user_id, score DESC, candidate_id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_deck_candidate ON candidate_deck (candidate_id)")
+
+# Индексы под горячие запросы. Поиск по tg_id и проверки пар (user_id, X)
+# уже обслуживают автоиндексы UNIQUE-ограничений, здесь — то, чего не хватало.
+def _migration_hot_indexes(cur):
+    # Последний показанный профиль (SQL_LAST_SHOWN): покрывающий индекс, без сортировки
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_shown_recent ON shown (user_id, id DESC, shown_user_id)")
+    # Обратное направление лайков: «кто лайкнул пользователя»
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_likes_liked ON likes (liked_user_id, user_id)")
+
+# Состояния FSM (см. storage.SQLiteStorage); data и bucket — JSON
+def _migration_fsm(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS fsm (
+        chat INTEGER,
+        user INTEGER,
+        state TEXT,
+        data TEXT,
+        bucket TEXT,
+        updated_at REAL,
+        PRIMARY KEY (chat, user)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_fsm_updated ON fsm (updated_at)")
+
+# Вместо строки shown на каждую пару (зритель, анкета) — одна строка seen на зрителя
+# с отсортированными id просмотренных в BLOB (см. «Просмотренные анкеты» ниже)
+def _migration_seen_sets(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS seen (
+        user_id INTEGER PRIMARY KEY,
+        epoch_started REAL NOT NULL,
+        current BLOB NOT NULL,
+        previous BLOB NOT NULL,
+        last_shown INTEGER
+    )
+    """)
+    now = time.time()
+    user_id, ids, last = None, [], None
+    # Читаем отдельным курсором, чтобы не держать всю таблицу shown в памяти
+    for viewer, shown_user_id in cur.connection.execute("SELECT user_id, shown_user_id FROM shown ORDER BY user_id, id"):
+        if viewer != user_id and user_id is not None:
+            save_seen(cur, user_id, now, pack_ids(sorted(set(ids))), b"", last)
+            ids = []
+        user_id, last = viewer, shown_user_id
+        ids.append(shown_user_id)
+    if user_id is not None:
+        save_seen(cur, user_id, now, pack_ids(sorted(set(ids))), b"", last)
+    cur.execute("DROP TABLE shown")
+
+# Совпадения (взаимные лайки) — по строке на каждого участника, см. record_like.
+# Уже существующие взаимные лайки переносятся сюда.
+def _migration_matches(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS matches (
+        user_id INTEGER,
+        match_user_id INTEGER,
+        created_at REAL,
+        PRIMARY KEY (user_id, match_user_id)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_matches_recent ON matches (user_id, created_at DESC, match_user_id DESC)")
+    cur.execute(SQL_BACKFILL_MATCHES, (time.time(),))
+
+# Совпадения для всех взаимных лайков, которых ещё нет в matches (миграция, импорт лайков)
+SQL_BACKFILL_MATCHES = """
+    INSERT OR IGNORE INTO matches (user_id, match_user_id, created_at)
+    SELECT a.user_id, a.liked_user_id, ?
+    FROM likes a
+    JOIN likes b ON b.user_id = a.liked_user_id AND b.liked_user_id = a.user_id
+"""
+
+# Фильтры поиска: факультет хранится ещё и нормализованным id (faculties), чтобы разные
+# написания одного факультета совпадали; составные индексы по (факультет, курс, возраст)
+# дают фильтрованному поиску читать только подходящий срез users.
+def _migration_filters(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS faculties (
+        id INTEGER PRIMARY KEY,
+        key TEXT UNIQUE NOT NULL,
+        name TEXT NOT NULL
+    )
+    """)
+    columns = [r[1] for r in cur.execute("PRAGMA table_info(users)")]
+    if "faculty_id" not in columns:
+        cur.execute("ALTER TABLE users ADD COLUMN faculty_id INTEGER")
+    # Нормализация в Python, но за один проход по users
+    cur.connection.create_function("faculty_key", 1, faculty_key, deterministic=True)
+    cur.execute("""
+    INSERT OR IGNORE INTO faculties (key, name)
+    SELECT faculty_key(faculty), faculty FROM users
+    WHERE faculty IS NOT NULL AND faculty_key(faculty) != ''
+    ORDER BY id
+    """)
+    cur.execute("""
+    UPDATE users SET faculty_id = (SELECT f.id FROM faculties f WHERE f.key = faculty_key(users.faculty))
+    WHERE faculty IS NOT NULL AND faculty != ''
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_filter ON users (faculty_id, course, age)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_course_age ON users (course, age)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_age ON users (age)")
+    # NULL в колонке фильтра — «не важно»
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_filters (
+        user_id INTEGER PRIMARY KEY,
+        age_min INTEGER,
+        age_max INTEGER,
+        faculty_id INTEGER,
+        course TEXT
+    )
+    """)
+
+# Различные маски интересов со счётчиком пользователей: ранжирование сначала перебирает
+# маски (их не больше 2^len(INTERESTS), сколько бы ни было пользователей), а пользователей
+# с нужной маской берёт по idx_users_mask. Счётчики ведут триггеры на users, поэтому их
+# не обходит ни upsert_user, ни импорт admin.py, ни прямые INSERT в bench.py.
+def _migration_interest_masks(cur):
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_users_mask ON users (interests_mask)")
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS interest_masks (
+        mask INTEGER PRIMARY KEY,
+        users INTEGER NOT NULL
+    )
+    """)
+    cur.execute("DELETE FROM interest_masks")
+    cur.execute("INSERT INTO interest_masks (mask, users) SELECT interests_mask, COUNT(*) FROM users GROUP BY interests_mask")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_mask_insert AFTER INSERT ON users
+    BEGIN
+        INSERT OR IGNORE INTO interest_masks (mask, users) VALUES (NEW.interests_mask, 0);
+        UPDATE interest_masks SET users = users + 1 WHERE mask = NEW.interests_mask;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_mask_update AFTER UPDATE OF interests_mask ON users
+    WHEN OLD.interests_mask IS NOT NEW.interests_mask
+    BEGIN
+        UPDATE interest_masks SET users = users - 1 WHERE mask = OLD.interests_mask;
+        DELETE FROM interest_masks WHERE mask = OLD.interests_mask AND users <= 0;
+        INSERT OR IGNORE INTO interest_masks (mask, users) VALUES (NEW.interests_mask, 0);
+        UPDATE interest_masks SET users = users + 1 WHERE mask = NEW.interests_mask;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_mask_delete AFTER DELETE ON users
+    BEGIN
+        UPDATE interest_masks SET users = users - 1 WHERE mask = OLD.interests_mask;
+        DELETE FROM interest_masks WHERE mask = OLD.interests_mask AND users <= 0;
+    END
+    """)
+
+# Время последнего пополнения каждой колоды — по нему удаляются колоды ушедших пользователей
+def _migration_deck_fills(cur):
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS deck_fills (
+        user_id INTEGER PRIMARY KEY,
+        filled_at REAL NOT NULL
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_deck_fills_age ON deck_fills (filled_at)")
+    cur.execute("INSERT OR IGNORE INTO deck_fills (user_id, filled_at) SELECT DISTINCT user_id, ? FROM candidate_deck", (time.time(),))
+
+# Число пользователей каждого факультета — для кнопок /settings без GROUP BY по users.
+# Как и interest_masks, его ведут триггеры на users (upsert_user, импорт, bench).
+def _migration_faculty_users(cur):
+    columns = [r[1] for r in cur.execute("PRAGMA table_info(faculties)")]
+    if "users" not in columns:
+        cur.execute("ALTER TABLE faculties ADD COLUMN users INTEGER NOT NULL DEFAULT 0")
+    cur.execute("UPDATE faculties SET users = (SELECT COUNT(*) FROM users u WHERE u.faculty_id = faculties.id)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_faculties_users ON faculties (users DESC, id)")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_faculty_insert AFTER INSERT ON users
+    WHEN NEW.faculty_id IS NOT NULL
+    BEGIN
+        UPDATE faculties SET users = users + 1 WHERE id = NEW.faculty_id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_faculty_update AFTER UPDATE OF faculty_id ON users
+    WHEN OLD.faculty_id IS NOT NEW.faculty_id
+    BEGIN
+        UPDATE faculties SET users = users - 1 WHERE id = OLD.faculty_id;
+        UPDATE faculties SET users = users + 1 WHERE id = NEW.faculty_id;
+    END
+    """)
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_users_faculty_delete AFTER DELETE ON users
+    WHEN OLD.faculty_id IS NOT NULL
+    BEGIN
+        UPDATE faculties SET users = users - 1 WHERE id = OLD.faculty_id;
+    END
+    """)
+
+MIGRATIONS = [
+    _migration_base,
+    _migration_interests_mask,
+    _migration_candidate_deck,
+    _migration_hot_indexes,
+    _migration_fsm,
+    _migration_seen_sets,
+    _migration_matches,
+    _migration_filters,
+    _migration_interest_masks,
+    _migration_deck_fills,
+    _migration_faculty_users,
+]
+
+def schema_version(cur) -> int:
+    return cur.execute("PRAGMA user_version").fetchone()[0]
+
+def migrate(cur):
+    version = schema_version(cur)
+    for number, step in enumerate(MIGRATIONS[version:], start=version + 1):
+        logger.info("Миграция схемы %s: %s", number, step.__name__)
+        step(cur)
+        cur.execute(f"PRAGMA user_version = {number}")
+    return len(MIGRATIONS)
+
+def init_db():
+    with transaction() as cur:
+        return migrate(cur)
+
+def set_user_interests(cur, user_id: int, mask: int):
+    cur.execute("DELETE FROM user_interests WHERE user_id = ?", (user_id,))
+    cur.executemany("INSERT INTO user_interests (interest_id, user_id) VALUES (?, ?)", [(i, user_id) for i in mask_to_ids(mask)])
+
+# === Факультеты ===
+# Факультет вводится свободным текстом: «Финансовый факультет», «финансовый ф-т» и
+# «Финансовый» должны давать один faculty_id
+FACULTY_STOPWORDS = {"факультет", "фак", "ф", "т"}
+
+def faculty_key(name: str) -> str:
+    words = re.sub(r"[^\w]+", " ", (name or "").lower().replace("ё", "е")).split()
+    return " ".join(w for w in words if w not in FACULTY_STOPWORDS)
+
+def faculty_id_for(cur, name: str):
+    key = faculty_key(name)
+    if not key:
+        return None
+    cur.execute("INSERT OR IGNORE INTO faculties (key, name) VALUES (?, ?)", (key, name.strip()))
+    return cur.execute("SELECT id FROM faculties WHERE key = ?", (key,)).fetchone()[0]
+
+# === Кэш профилей ===
+class ProfileCache:
+    """LRU-кэш декодированных профилей с TTL, доступный и по tg_id, и по внутреннему id.
+
+    Запись инвалидируется при каждом изменении профиля через upsert_user.
+    Счётчик поколений не даёт положить в кэш профиль, прочитанный до инвалидации.
+    listeners вызываются с id изменённого профиля (workers.py рассылает его другим процессам).
+    """
+
+    def __init__(self, maxsize: int = PROFILE_CACHE_SIZE, ttl: float = PROFILE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._by_id = OrderedDict()
+        self._tg_to_id = {}
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.listeners = []
+
+    @property
+    def generation(self) -> int:
+        return self._generation
+
+    def _get(self, user_id):
+        entry = self._by_id.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires, user = entry
+        if expires < time.monotonic():
+            self._drop(user_id)
+            self.misses += 1
+            return None
+        self._by_id.move_to_end(user_id)
+        self.hits += 1
+        return user
+
+    def get_by_id(self, user_id: int):
+        with self._lock:
+            return self._get(user_id)
+
+    def get_by_tg(self, tg_id: int):
+        with self._lock:
+            return self._get(self._tg_to_id.get(tg_id))
+
+    def put(self, user: dict, generation: int = None):
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._drop(user["id"])
+            self._by_id[user["id"]] = (time.monotonic() + self.ttl, user)
+            self._tg_to_id[user["tg_id"]] = user["id"]
+            while len(self._by_id) > self.maxsize:
+                self._drop(next(iter(self._by_id)))
+                self.evictions += 1
+
+    def invalidate(self, tg_id: int = None, user_id: int = None, notify: bool = True):
+        with self._lock:
+            self._generation += 1
+            self.invalidations += 1
+            if user_id is None:
+                user_id = self._tg_to_id.get(tg_id)
+            self._drop(user_id)
+        if notify and user_id is not None:
+            for listener in self.listeners:
+                listener(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._by_id.clear()
+            self._tg_to_id.clear()
+
+    def _drop(self, user_id):
+        entry = self._by_id.pop(user_id, None)
+        if entry is not None:
+            self._tg_to_id.pop(entry[1]["tg_id"], None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._by_id),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 3) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+profile_cache = ProfileCache()
+
+# === Утилиты работы с БД ===
+def upsert_user(tg_id: int, name: str = None, age: int = None, faculty: str = None, course: str = None, photo_file_id: str = None, interests: List[str] = None):
+    mask = interests_to_mask(interests) if interests is not None else None
+    with transaction() as cur:
+        faculty_id = faculty_id_for(cur, faculty) if faculty is not None else None
+        cur.execute("SELECT id, interests_mask, age, faculty_id, course FROM users WHERE tg_id = ?", (tg_id,))
+        existing = cur.fetchone()
+        if existing:
+            user_id, old_mask, *old_attrs = existing
+            fields = []
+            params = []
+            if name is not None:
+                fields.append("name = ?"); params.append(name)
+            if age is not None:
+                fields.append("age = ?"); params.append(age)
+            if faculty is not None:
+                fields.append("faculty = ?"); params.append(faculty)
+                fields.append("faculty_id = ?"); params.append(faculty_id)
+            if course is not None:
+                fields.append("course = ?"); params.append(course)
+            if photo_file_id is not None:
+                fields.append("photo_file_id = ?"); params.append(photo_file_id)
+            if mask is not None:
+                fields.append("interests_mask = ?"); params.append(mask)
+            if fields:
+                sql = "UPDATE users SET " + ", ".join(fields) + " WHERE tg_id = ?"
+                params.append(tg_id)
+                cur.execute(sql, tuple(params))
+            # Возраст, факультет и курс проверяются фильтрами чужих колод
+            new_attrs = [age if age is not None else old_attrs[0],
+                         faculty_id if faculty is not None else old_attrs[1],
+                         course if course is not None else old_attrs[2]]
+            attrs_changed = new_attrs != old_attrs
+        else:
+            cur.execute("""
+                INSERT INTO users (tg_id, name, age, faculty, faculty_id, course, photo_file_id, interests_mask)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """, (tg_id, name or "", age or 0, faculty or "", faculty_id, course or "", photo_file_id or "", mask or 0))
+            user_id, old_mask, attrs_changed = cur.lastrowid, None, False
+        if mask is not None:
+            set_user_interests(cur, user_id, mask)
+        if (mask is not None and mask != old_mask) or attrs_changed:
+            invalidate_decks(cur, user_id)
+    profile_cache.invalidate(user_id=user_id)
+
+USER_COLUMNS = "id, tg_id, name, age, faculty, course, photo_file_id, interests_mask"
+
+def row_to_user(row):
+    id_, tg_id, name, age, faculty, course, photo_file_id, interests_mask = row
+    return {"id": id_, "tg_id": tg_id, "name": name, "age": age, "faculty": faculty, "course": course, "photo_file_id": photo_file_id, "interests": mask_to_interests(interests_mask), "interests_mask": interests_mask}
+
+# Горячие запросы вынесены в константы: их планы проверяет check_queries.py
+SQL_USER_BY_TG = f"SELECT {USER_COLUMNS} FROM users WHERE tg_id = ?"
+SQL_USER_BY_ID = f"SELECT {USER_COLUMNS} FROM users WHERE id = ?"
+
+def get_user_by_tg(tg_id: int):
+    cur = get_db_connection().cursor()
+    cur.execute(SQL_USER_BY_TG, (tg_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return row_to_user(row)
+
+def get_user_by_id(user_id: int):
+    cur = get_db_connection().cursor()
+    cur.execute(SQL_USER_BY_ID, (user_id,))
+    row = cur.fetchone()
+    if not row:
+        return None
+    return row_to_user(row)
+
+# === Просмотренные анкеты ===
+# У каждого зрителя одна строка seen: отсортированные id просмотренных анкет в BLOB
+# (uint32 little-endian, 4 байта на анкету), поэтому место растёт с числом активных
+# пользователей и их просмотров, а не с числом пар, и нет индекса на каждую пару.
+# Хранение по эпохам: новые просмотры пишутся в current; раз в SEEN_EPOCH current
+# становится previous, а старый previous отбрасывается — эти анкеты снова попадут в выдачу.
+SQL_SEEN = "SELECT epoch_started, current, previous, last_shown FROM seen WHERE user_id = ?"
+SQL_LAST_SHOWN = "SELECT last_shown FROM seen WHERE user_id = ?"
+
+def pack_ids(ids) -> bytes:
+    packed = array("I", ids)
+    if sys.byteorder == "big":
+        packed.byteswap()
+    return packed.tobytes()
+
+def unpack_ids(blob: bytes) -> array:
+    ids = array("I")
+    ids.frombytes(blob or b"")
+    if sys.byteorder == "big":
+        ids.byteswap()
+    return ids
+
+def contains_id(ids: array, value: int) -> bool:
+    i = bisect.bisect_left(ids, value)
+    return i < len(ids) and ids[i] == value
+
+def save_seen(cur, user_id: int, epoch_started: float, current: bytes, previous: bytes, last_shown: int):
+    cur.execute("INSERT OR REPLACE INTO seen (user_id, epoch_started, current, previous, last_shown) VALUES (?, ?, ?, ?, ?)",
+                (user_id, epoch_started, current, previous, last_shown))
+
+def load_seen(cur, user_id: int, now: float = None):
+    """Возвращает (epoch_started, current, previous, last_shown) с учётом смены эпох на момент now."""
+    now = now or time.time()
+    row = cur.execute(SQL_SEEN, (user_id,)).fetchone()
+    if not row:
+        return now, array("I"), array("I"), None
+    epoch_started, current, previous, last_shown = row
+    age = now - epoch_started
+    if age >= 2 * SEEN_EPOCH:
+        return now, array("I"), array("I"), last_shown
+    if age >= SEEN_EPOCH:
+        return now, array("I"), unpack_ids(current), last_shown
+    return epoch_started, unpack_ids(current), unpack_ids(previous), last_shown
+
+def add_seen(cur, user_id: int, shown_user_ids: list, now: float = None):
+    epoch_started, current, previous, _ = load_seen(cur, user_id, now)
+    merged = sorted(set(current).union(shown_user_ids))
+    save_seen(cur, user_id, epoch_started, pack_ids(merged), pack_ids(previous), shown_user_ids[-1])
+
+# Ранжирование кандидатов без чтения всей таблицы users.
+# Оценка кандидата — popcount(маска_я & маска_кандидата), поэтому у всех пользователей
+# с одной маской она одна и та же. Сначала упорядочиваем различные маски (interest_masks,
+# не больше 2^len(INTERESTS) строк) по оценке, затем берём пользователей лучших масок
+# по idx_users_mask в порядке id и останавливаемся, как только набрано limit.
+# Уже показанные отсекаются в Python по множеству из seen: их не больше, чем просмотров.
+SQL_MASKS = "SELECT mask FROM interest_masks"
+SQL_USERS_BY_MASK = "SELECT id FROM users WHERE interests_mask = ? AND id > ? ORDER BY id LIMIT ?"
+
+def popcount(mask: int) -> int:
+    return bin(mask).count("1")
+
+# С фильтрами поиска кандидаты берутся из среза users по составному индексу
+# (faculty_id, course, age) или (course, age) / (age), а не из user_interests:
+# совпадения интересов считаются по маске прямо в этом срезе (popcount через сдвиги).
+POPCOUNT_SQL = " + ".join(f"((m >> {bit}) & 1)" for bit in range(len(INTERESTS)))
+SQL_RANK_FILTERED = """
+    SELECT id, """ + POPCOUNT_SQL + """ AS score
+    FROM (
+        SELECT u.id, u.interests_mask & ? AS m
+        FROM users u
+        WHERE {where}
+          AND u.id != ?
+          AND u.id NOT IN (SELECT value FROM json_each(?))
+    )
+    ORDER BY score DESC, id
+    LIMIT ?
+"""
+SQL_FILTERS = "SELECT age_min, age_max, faculty_id, course FROM user_filters WHERE user_id = ?"
+FILTER_FIELDS = ("age_min", "age_max", "faculty_id", "course")
+
+def placeholders(values) -> str:
+    return ", ".join("?" * len(values))
+
+def filter_clause(filters: dict):
+    # Порядок условий совпадает с порядком колонок idx_users_filter
+    clauses, params = [], []
+    if filters.get("faculty_id") is not None:
+        clauses.append("u.faculty_id = ?"); params.append(filters["faculty_id"])
+    if filters.get("course") is not None:
+        clauses.append("u.course = ?"); params.append(filters["course"])
+    if filters.get("age_min") is not None:
+        clauses.append("u.age >= ?"); params.append(filters["age_min"])
+    if filters.get("age_max") is not None:
+        clauses.append("u.age <= ?"); params.append(filters["age_max"])
+    return " AND ".join(clauses), params
+
+def load_filters(cur, user_id: int) -> dict:
+    row = cur.execute(SQL_FILTERS, (user_id,)).fetchone()
+    return dict(zip(FILTER_FIELDS, row)) if row else {}
+
+def rank_candidates(cur, me: dict, limit: int, seen=frozenset()):
+    # seen — id уже показанных (и ещё не записанных в seen) кандидатов
+    where, params = filter_clause(load_filters(cur, me['id']))
+    if where:
+        cur.execute(SQL_RANK_FILTERED.format(where=where),
+                    (me.get("interests_mask", 0), *params, me['id'], json.dumps(sorted(seen)), limit))
+        return cur.fetchall()
+    my_mask = me.get("interests_mask", 0)
+    # При равной оценке — по маске, внутри маски — по id
+    scored = sorted((-popcount(mask & my_mask), mask) for mask, in cur.execute(SQL_MASKS))
+    ranked = []
+    for negative_score, mask in scored:
+        after = 0
+        while len(ranked) < limit:
+            batch = limit - len(ranked)
+            rows = cur.execute(SQL_USERS_BY_MASK, (mask, after, batch)).fetchall()
+            ranked += [(user_id, -negative_score) for user_id, in rows if user_id != me['id'] and user_id not in seen]
+            if len(rows) < batch:
+                break
+            after = rows[-1][0]
+        if len(ranked) >= limit:
+            break
+    return ranked
+
+# Колоды, не пополнявшиеся дольше DECK_TTL, удаляются понемногу при пополнении чужих колод
+SQL_IDLE_DECKS = "SELECT user_id FROM deck_fills WHERE filled_at < ? ORDER BY filled_at LIMIT ?"
+
+def expire_decks(cur, now: float = None):
+    now = now or time.time()
+    user_ids = json.dumps([row[0] for row in cur.execute(SQL_IDLE_DECKS, (now - DECK_TTL, DECK_PRUNE_BATCH))])
+    cur.execute("DELETE FROM candidate_deck WHERE user_id IN (SELECT value FROM json_each(?))", (user_ids,))
+    cur.execute("DELETE FROM deck_fills WHERE user_id IN (SELECT value FROM json_each(?))", (user_ids,))
+
+def write_deck(cur, user_id: int, ranked):
+    now = time.time()
+    expire_decks(cur, now)
+    cur.execute("DELETE FROM candidate_deck WHERE user_id = ?", (user_id,))
+    cur.executemany("INSERT INTO candidate_deck (user_id, candidate_id, score) VALUES (?, ?, ?)",
+                    [(user_id, candidate_id, score) for candidate_id, score in ranked])
+    cur.execute("INSERT OR REPLACE INTO deck_fills (user_id, filled_at) VALUES (?, ?)", (user_id, now))
+
+# Следующий кандидат — просто верхняя карта колоды. Полное ранжирование выполняется
+# только когда колода опустела, т.е. раз в DECK_BATCH свайпов, и идёт в читающей
+# транзакции: блокировку записи (одну на всю базу) держат только вытягивание карты
+# и запись новой колоды, поэтому пополнение колоды одного пользователя не задерживает
+# лайки и показы остальных.
+# Карты, просмотренные уже после сборки колоды (например, показанные параллельным
+# запросом), отбрасываются при вытягивании проверкой по seen.
+SQL_DECK_TOP = """
+    SELECT d.score, u.id, u.tg_id, u.name, u.age, u.faculty, u.course, u.photo_file_id, u.interests_mask
+    FROM candidate_deck d
+    JOIN users u ON u.id = d.candidate_id
+    WHERE d.user_id = ?
+    ORDER BY d.score DESC, d.candidate_id
+    LIMIT 1
+"""
+
+def take_deck_top(cur, me: dict, exclude=()):
+    _, current, previous, _ = load_seen(cur, me['id'])
+    while True:
+        cur.execute(SQL_DECK_TOP, (me['id'],))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        cur.execute("DELETE FROM candidate_deck WHERE user_id = ? AND candidate_id = ?", (me['id'], row[1]))
+        if not (row[1] in exclude or contains_id(current, row[1]) or contains_id(previous, row[1])):
+            return row
+
+def pop_next_candidate(me: dict, exclude=()):
+    # exclude — кандидаты, показ которых ещё лежит в WriteBuffer и не записан в seen
+    with transaction() as cur:
+        row = take_deck_top(cur, me, exclude)
+    if row is None:
+        with transaction("DEFERRED") as cur:
+            _, current, previous, _ = load_seen(cur, me['id'])
+            ranked = rank_candidates(cur, me, DECK_BATCH, set().union(current, previous, exclude))
+        if ranked:
+            with transaction() as cur:
+                write_deck(cur, me['id'], ranked)
+                row = take_deck_top(cur, me, exclude)
+    if not row:
+        return None
+    return row[0], row_to_user(row[1:])
+
+# После регистрации, смены интересов, возраста, факультета или курса пользователя его
+# собственная колода пересоберётся при следующем показе, а из чужих колод он убирается:
+# оценка или проверка фильтров устарели. Заново в чужие колоды он попадёт при их
+# следующем пополнении — обходить все колоды внутри транзакции записи слишком дорого.
+def invalidate_decks(cur, user_id: int):
+    cur.execute("DELETE FROM candidate_deck WHERE user_id = ?", (user_id,))
+    cur.execute("DELETE FROM candidate_deck WHERE candidate_id = ?", (user_id,))
+
+def write_shown(shown: list):
+    # Одна транзакция (и один fsync) на всю пачку показов из WriteBuffer;
+    # BLOB каждого зрителя переписывается один раз на пачку
+    by_viewer = {}
+    for user_id, shown_user_id in shown:
+        by_viewer.setdefault(user_id, []).append(shown_user_id)
+    now = time.time()
+    with transaction() as cur:
+        for user_id, shown_user_ids in by_viewer.items():
+            add_seen(cur, user_id, shown_user_ids, now)
+
+def get_last_shown(user_id: int):
+    cur = get_db_connection().cursor()
+    cur.execute(SQL_LAST_SHOWN, (user_id,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+# === Лайки и совпадения ===
+# Совпадение хранится двумя строками (по одной на каждого участника), чтобы /matches
+# читал список пользователя одним проходом по первичному ключу.
+SQL_MUTUAL_LIKE = "SELECT id FROM likes WHERE user_id = ? AND liked_user_id = ?"
+SQL_MATCHES_PAGE = """
+    SELECT u.id, u.tg_id, u.name, u.age, u.faculty, u.course, u.photo_file_id, u.interests_mask
+    FROM matches m
+    JOIN users u ON u.id = m.match_user_id
+    WHERE m.user_id = ?
+    ORDER BY m.created_at DESC, m.match_user_id DESC
+    LIMIT ? OFFSET ?
+"""
+
+def record_like(user_id: int, liked_user_id: int) -> bool:
+    """Лайк, проверка взаимности и запись совпадения в одной транзакции.
+
+    Возвращает True, только если совпадение возникло этим лайком: повторный лайк
+    старой карточки не приводит к повторным уведомлениям.
+    """
+    with transaction() as cur:
+        cur.execute("INSERT OR IGNORE INTO likes (user_id, liked_user_id) VALUES (?, ?)", (user_id, liked_user_id))
+        if not cur.execute(SQL_MUTUAL_LIKE, (liked_user_id, user_id)).fetchone():
+            return False
+        now = time.time()
+        cur.executemany("INSERT OR IGNORE INTO matches (user_id, match_user_id, created_at) VALUES (?, ?, ?)",
+                        [(user_id, liked_user_id, now), (liked_user_id, user_id, now)])
+        return cur.rowcount > 0
+
+def get_matches(user_id: int, limit: int, offset: int = 0) -> list:
+    cur = get_db_connection().cursor()
+    cur.execute(SQL_MATCHES_PAGE, (user_id, limit, offset))
+    return [row_to_user(row) for row in cur.fetchall()]
+
+# === Фильтры поиска ===
+def get_filters(user_id: int) -> dict:
+    return load_filters(get_db_connection().cursor(), user_id)
+
+def set_filters(user_id: int, **changes) -> dict:
+    """Меняет указанные фильтры (None — снять фильтр) и сбрасывает колоду пользователя:
+    она была отранжирована по старым условиям и пересоберётся при следующем показе."""
+    unknown = set(changes) - set(FILTER_FIELDS)
+    if unknown:
+        raise ValueError(f"Неизвестные фильтры: {', '.join(sorted(unknown))}")
+    with transaction() as cur:
+        filters = dict.fromkeys(FILTER_FIELDS)
+        filters.update(load_filters(cur, user_id))
+        filters.update(changes)
+        if any(v is not None for v in filters.values()):
+            cur.execute("INSERT OR REPLACE INTO user_filters (user_id, age_min, age_max, faculty_id, course) VALUES (?, ?, ?, ?, ?)",
+                        (user_id, *(filters[f] for f in FILTER_FIELDS)))
+        else:
+            cur.execute("DELETE FROM user_filters WHERE user_id = ?", (user_id,))
+        cur.execute("DELETE FROM candidate_deck WHERE user_id = ?", (user_id,))
+    return {f: v for f, v in filters.items() if v is not None}
+
+SQL_TOP_FACULTIES = "SELECT id, name FROM faculties WHERE users > 0 ORDER BY users DESC, id LIMIT ?"
+
+def list_faculties(limit: int = 10) -> list:
+    # Самые многочисленные факультеты — для кнопок в /settings
+    cur = get_db_connection().cursor()
+    cur.execute(SQL_TOP_FACULTIES, (limit,))
+    return cur.fetchall()
+
+def get_faculty_name(faculty_id: int):
+    row = get_db_connection().execute("SELECT name FROM faculties WHERE id = ?", (faculty_id,)).fetchone()
+    return row[0] if row else None
+
+# === Групповая запись показов ===
+class WriteBuffer:
+    """Копит показы анкет и пишет их одной транзакцией (group commit).
+
+    Свайп не ждёт записи: показ попадает в буфер, а пачка уходит в базу раз в interval
+    секунд или сразу при batch событиях. Пока показ не записан, чтения, которым он
+    важен (последний показ, фильтр уже показанных), смотрят сюда.
+    Работает в event loop; в базу пишет через пул Database.
+    """
+
+    def __init__(self, database: "Database", interval: float = WRITE_FLUSH_INTERVAL, batch: int = WRITE_BATCH):
+        self.database = database
+        self.interval = interval
+        self.batch = batch
+        self._shown = []
+        # Индексы по ещё не записанным показам, включая пачку, которая пишется прямо сейчас
+        self._last_shown = {}
+        self._pending_shown = {}
+        self._timer = None
+        self._flushing = None
+        self._lock = asyncio.Lock()
+        self.flushes = 0
+        self.written = 0
+
+    def add_shown(self, user_id: int, shown_user_id: int):
+        self._shown.append((user_id, shown_user_id))
+        self._last_shown[user_id] = shown_user_id
+        self._pending_shown.setdefault(user_id, set()).add(shown_user_id)
+        self._schedule()
+
+    def last_shown(self, user_id: int):
+        return self._last_shown.get(user_id)
+
+    def pending_shown(self, user_id: int) -> frozenset:
+        return frozenset(self._pending_shown.get(user_id, ()))
+
+    def _schedule(self):
+        if len(self._shown) >= self.batch:
+            self._kick()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self._kick)
+
+    def _kick(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushing is None or self._flushing.done():
+            self._flushing = asyncio.ensure_future(self._flush_in_background())
+
+    async def _flush_in_background(self):
+        # Запись пачки не относится ни к одному обновлению (см. metrics.py)
+        query_stats.set(None)
+        try:
+            await self.flush()
+        except Exception:
+            logger.exception("Не удалось записать показы, повтор через %s с", self.interval)
+        if self._shown and self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.interval, self._kick)
+
+    async def flush(self):
+        async with self._lock:
+            if not self._shown:
+                return
+            shown, self._shown = self._shown, []
+            try:
+                await self.database.run(write_shown, shown)
+            except Exception:
+                self._shown[:0] = shown
+                raise
+            self.flushes += 1
+            self.written += len(shown)
+            self._reindex()
+
+    def _reindex(self):
+        # После записи в индексах остаются только показы, пришедшие во время неё
+        self._last_shown, self._pending_shown = {}, {}
+        for user_id, shown_user_id in self._shown:
+            self._last_shown[user_id] = shown_user_id
+            self._pending_shown.setdefault(user_id, set()).add(shown_user_id)
+
+    def stats(self) -> dict:
+        return {"pending": len(self._shown), "flushes": self.flushes, "written": self.written,
+                "events_per_flush": round(self.written / self.flushes, 1) if self.flushes else 0.0}
+
+    async def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if self._flushing is not None:
+            await asyncio.gather(self._flushing, return_exceptions=True)
+        await self.flush()
+
+# === Асинхронный фасад для хендлеров ===
+class Database:
+    """Выполняет функции модуля в пуле потоков и отдаёт awaitable-обёртки для хендлеров."""
+
+    def __init__(self, pool_size: int = DB_POOL_SIZE):
+        self._executor = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix="db")
+        self.writes = WriteBuffer(self)
+
+    async def run(self, fn, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        stats = query_stats.get()
+        if stats is None:
+            return await loop.run_in_executor(self._executor, functools.partial(fn, *args, **kwargs))
+        # Время считается вместе с ожиданием свободного потока: именно столько обновление ждёт базу
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(self._executor, contextvars.copy_context().run,
+                                              functools.partial(fn, *args, **kwargs))
+        finally:
+            stats.calls += 1
+            stats.seconds += time.perf_counter() - started
+
+    async def init(self):
+        return await self.run(init_db)
+
+    async def upsert_user(self, tg_id: int, **fields):
+        return await self.run(upsert_user, tg_id, **fields)
+
+    # Профили читаются из кэша без похода в пул потоков
+    async def get_user_by_tg(self, tg_id: int):
+        user = profile_cache.get_by_tg(tg_id)
+        if user is None:
+            generation = profile_cache.generation
+            user = await self.run(get_user_by_tg, tg_id)
+            if user is not None:
+                profile_cache.put(user, generation)
+        return user
+
+    async def get_user_by_id(self, user_id: int):
+        user = profile_cache.get_by_id(user_id)
+        if user is None:
+            generation = profile_cache.generation
+            user = await self.run(get_user_by_id, user_id)
+            if user is not None:
+                profile_cache.put(user, generation)
+        return user
+
+    async def pop_next_candidate(self, me: dict):
+        return await self.run(pop_next_candidate, me, self.writes.pending_shown(me['id']))
+
+    # Показы пишутся через WriteBuffer; чтения сначала смотрят в него
+    async def mark_shown(self, user_id: int, shown_user_id: int):
+        self.writes.add_shown(user_id, shown_user_id)
+
+    async def get_last_shown(self, user_id: int):
+        pending = self.writes.last_shown(user_id)
+        if pending is not None:
+            return pending
+        return await self.run(get_last_shown, user_id)
+
+    async def record_like(self, user_id: int, liked_user_id: int) -> bool:
+        return await self.run(record_like, user_id, liked_user_id)
+
+    async def get_matches(self, user_id: int, limit: int, offset: int = 0) -> list:
+        return await self.run(get_matches, user_id, limit, offset)
+
+    async def get_filters(self, user_id: int) -> dict:
+        return await self.run(get_filters, user_id)
+
+    async def set_filters(self, user_id: int, **changes) -> dict:
+        return await self.run(set_filters, user_id, **changes)
+
+    async def list_faculties(self, limit: int = 10) -> list:
+        return await self.run(list_faculties, limit)
+
+    async def get_faculty_name(self, faculty_id: int):
+        return await self.run(get_faculty_name, faculty_id)
+
+    def close(self):
+        # Буфер записей должен быть сброшен раньше (await db.writes.close()).
+        # Соединения живут в потоках пула, поэтому закрываем их после остановки пула
+        self._executor.shutdown(wait=True)
+        close_connections()
+
+db = Database()
@@ -0,0 +1,313 @@
+# coding: utf-8
+
+"""
+Метрики горячего пути.
+
+MetricsMiddleware замеряет каждое обновление: какой хендлер его обработал, сколько оно
+шло целиком, сколько из этого ждало базу и сколько SQL-выражений выполнило (db.QueryStats).
+QueuedBot пишет сюда задержку запросов к Bot API по методам.
+
+Всё собирается в registry и отдаётся в текстовом формате Prometheus (/metrics),
+а при METRICS_DUMP_INTERVAL > 0 ещё и пишется в лог одной JSON-строкой.
+При PROFILE_SLOW_UPDATES=1 фоновый поток снимает стеки event loop, и для медленных
+обновлений в лог попадают самые частые стеки за время их обработки.
+"""
+
+import asyncio
+import bisect
+import contextvars
+import json
+import logging
+import os
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+
+from aiogram.dispatcher.handler import current_handler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+from aiohttp import web
+
+import db
+
+logger = logging.getLogger(__name__)
+
+# Порт отдельного сервера /metrics в режиме polling (0 — не запускать); в webhook-режиме /metrics на порту бота
+METRICS_PORT = int(os.environ.get("METRICS_PORT", "0"))
+METRICS_PATH = os.environ.get("METRICS_PATH", "/metrics")
+# Раз в сколько секунд писать сводку метрик в лог (0 — не писать)
+METRICS_DUMP_INTERVAL = float(os.environ.get("METRICS_DUMP_INTERVAL", "0"))
+# Обновления дольше этого порога логируются с разбивкой по времени
+SLOW_UPDATE_SECONDS = float(os.environ.get("SLOW_UPDATE_SECONDS", "1.0"))
+PROFILE_SLOW_UPDATES = os.environ.get("PROFILE_SLOW_UPDATES", "0") == "1"
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.005"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+HELP = {
+    "bot_update_seconds": ("histogram", "Время обработки обновления по хендлерам"),
+    "bot_update_db_seconds": ("histogram", "Время ожидания базы за одно обновление"),
+    "bot_update_sql_statements": ("histogram", "SQL-выражений на одно обновление"),
+    "bot_update_errors_total": ("counter", "Обновления, завершившиеся исключением"),
+    "telegram_request_seconds": ("histogram", "Задержка запросов к Bot API по методам"),
+    "telegram_request_errors_total": ("counter", "Ошибки запросов к Bot API"),
+    "throttled_updates_total": ("counter", "Обновления, отброшенные (rate) или склеенные (duplicate) ограничением частоты"),
+    "worker_errors_total": ("counter", "Обновления, упавшие в процессе-обработчике"),
+    "worker_restarts_total": ("counter", "Перезапуски упавших процессов-обработчиков"),
+    "worker_queue_backlog": ("gauge", "Обновления в очереди процесса-обработчика"),
+    "worker_cpu_seconds": ("gauge", "Процессорное время процесса-обработчика"),
+    "worker_outbox_pending": ("gauge", "Исходящие запросы процесса-обработчика, ещё не отправленные в Telegram"),
+}
+
+class Histogram:
+    """Гистограмма с фиксированными границами, как в Prometheus."""
+    __slots__ = ("bounds", "counts", "sum", "count")
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # Оценка по границам корзин с линейной интерполяцией внутри корзины
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(self.bounds):
+                    return self.bounds[-1]
+                low = self.bounds[i - 1] if i else 0.0
+                return low + (self.bounds[i] - low) * (rank - seen) / n
+            seen += n
+        return self.bounds[-1]
+
+class Registry:
+    def __init__(self):
+        self._histograms = {}
+        self._counters = Counter()
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, value: float, bounds=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(bounds)
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        with self._lock:
+            self._counters[(name, tuple(sorted(labels.items())))] += value
+
+    def add_collector(self, collect):
+        """collect() -> {имя: значение} — значения снимаются в момент запроса метрик.
+        Имя может содержать метки: "name" + format_labels(...)."""
+        self._collectors.append(collect)
+
+    def gauges(self) -> dict:
+        values = {}
+        for collect in self._collectors:
+            try:
+                values.update(collect())
+            except Exception:
+                logger.exception("Сбой сборщика метрик")
+        return values
+
+    def render(self) -> str:
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                kind, text = HELP.get(name, (kind, ""))
+                if text:
+                    lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        for (name, labels), h in histograms:
+            header(name, "histogram")
+            cumulative = 0
+            for bound, n in zip(h.bounds, h.counts):
+                cumulative += n
+                lines.append(f"{name}_bucket{format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{format_labels(labels + (('le', '+Inf'),))} {h.count}")
+            lines.append(f"{name}_sum{format_labels(labels)} {h.sum:.6f}")
+            lines.append(f"{name}_count{format_labels(labels)} {h.count}")
+        for (name, labels), value in counters:
+            header(name, "counter")
+            lines.append(f"{name}{format_labels(labels)} {value}")
+        for name, value in sorted(self.gauges().items()):
+            header(name.partition("{")[0], "gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        """Короткая сводка для лога: p50/p99 (по корзинам) и количество по каждой гистограмме."""
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        summary = {}
+        for (name, labels), h in histograms:
+            key = name + format_labels(labels)
+            summary[key] = {"count": h.count, "mean": round(h.sum / h.count, 4) if h.count else 0.0,
+                            "p50": round(h.quantile(0.5), 4), "p99": round(h.quantile(0.99), 4)}
+        for (name, labels), value in counters:
+            summary[name + format_labels(labels)] = value
+        summary.update(self.gauges())
+        return summary
+
+def format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels) + "}"
+
+registry = Registry()
+
+# === Замер обновлений ===
+class UpdateTimer:
+    __slots__ = ("handler", "started", "seconds", "queries", "error")
+
+    def __init__(self):
+        self.handler = None
+        self.started = time.perf_counter()
+        self.seconds = 0.0
+        self.queries = db.QueryStats()
+        self.error = None
+
+current_update = contextvars.ContextVar("current_update", default=None)
+
+class MetricsMiddleware(BaseMiddleware):
+    """Замеряет каждое обновление и раздаёт итог слушателям (например, SlowUpdateProfiler)."""
+
+    def __init__(self, registry: Registry = registry, slow_seconds: float = SLOW_UPDATE_SECONDS):
+        super().__init__()
+        self.registry = registry
+        self.slow_seconds = slow_seconds
+        self.listeners = []
+
+    async def on_pre_process_update(self, update, data):
+        timer = UpdateTimer()
+        current_update.set(timer)
+        db.query_stats.set(timer.queries)
+
+    async def on_process_message(self, message, data):
+        self._handler_found()
+
+    async def on_process_callback_query(self, callback, data):
+        self._handler_found()
+
+    async def on_error(self, update, exception):
+        """Регистрируется через dp.register_errors_handler; ошибку не глушит."""
+        timer = current_update.get()
+        if timer is not None:
+            timer.error = exception
+
+    def _handler_found(self):
+        timer = current_update.get()
+        if timer is not None:
+            timer.handler = current_handler.get().__name__
+
+    async def on_post_process_update(self, update, results, data):
+        timer = current_update.get()
+        if timer is None:
+            return
+        timer.seconds = time.perf_counter() - timer.started
+        handler = timer.handler or "unhandled"
+        self.registry.observe("bot_update_seconds", timer.seconds, handler=handler)
+        self.registry.observe("bot_update_db_seconds", timer.queries.seconds, handler=handler)
+        self.registry.observe("bot_update_sql_statements", timer.queries.statements, bounds=COUNT_BUCKETS, handler=handler)
+        if timer.error is not None:
+            self.registry.inc("bot_update_errors_total", handler=handler)
+        if timer.seconds >= self.slow_seconds:
+            logger.warning("Медленное обновление %s: %s за %.3f с (база %.3f с, %s вызовов, %s SQL)",
+                           update.update_id, handler, timer.seconds, timer.queries.seconds,
+                           timer.queries.calls, timer.queries.statements)
+        for listener in self.listeners:
+            listener(timer)
+
+# === Профилирование медленных обновлений ===
+class SlowUpdateProfiler:
+    """Сэмплирующий профайлер потока event loop.
+
+    Раз в interval секунд снимает стек потока, в котором крутится event loop, и хранит
+    последние снимки. Для обновления дольше slow_seconds печатает самые частые стеки
+    за время его обработки: стеки внутри select означают, что loop простаивал (ждал базу
+    или сеть), остальные — где он был занят, пока обновление ждало своей очереди.
+    """
+
+    def __init__(self, slow_seconds: float = SLOW_UPDATE_SECONDS, interval: float = PROFILE_INTERVAL,
+                 keep_seconds: float = 30.0, top: int = 5):
+        self.slow_seconds = slow_seconds
+        self.interval = interval
+        self.top = top
+        self._samples = deque(maxlen=max(1, int(keep_seconds / interval)))
+        self._thread = None
+        self._stop = threading.Event()
+        self._target = None
+
+    def start(self):
+        self._target = threading.get_ident()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._sample, name="slow-update-profiler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                stack = tuple(f"{fs.name} ({os.path.basename(fs.filename)}:{fs.lineno})"
+                              for fs in traceback.extract_stack(frame, limit=12))
+                self._samples.append((time.perf_counter(), stack))
+
+    def __call__(self, timer: UpdateTimer):
+        if timer.seconds < self.slow_seconds:
+            return
+        finished = timer.started + timer.seconds
+        stacks = Counter(stack for at, stack in list(self._samples) if timer.started <= at <= finished)
+        if not stacks:
+            return
+        total = sum(stacks.values())
+        lines = [f"{n * 100 // total:3d}%  " + ";".join(stack) for stack, n in stacks.most_common(self.top)]
+        logger.warning("Профиль медленного обновления (%s, %s снимков):\n%s", timer.handler, total, "\n".join(lines))
+
+# === Отдача метрик ===
+async def metrics_view(request: web.Request):
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+def setup_routes(app: web.Application, path: str = METRICS_PATH):
+    app.router.add_get(path, metrics_view)
+
+async def start_server(port: int = METRICS_PORT, host: str = "0.0.0.0") -> web.AppRunner:
+    app = web.Application()
+    setup_routes(app)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Метрики доступны на http://%s:%s%s", host, port, METRICS_PATH)
+    return runner
+
+async def dump_loop(interval: float = METRICS_DUMP_INTERVAL):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("metrics %s", json.dumps(registry.snapshot(), ensure_ascii=False))
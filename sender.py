@@ -0,0 +1,403 @@
+# coding: utf-8
+
+"""
+Очередь исходящих сообщений с учётом лимитов Telegram.
+
+Все отправки (sendMessage, sendPhoto, правки клавиатур) проходят через Outbox:
+- ответы на действия пользователя (INTERACTIVE) обслуживаются раньше уведомлений (NOTIFICATION);
+- соблюдаются общий лимит бота и лимит на чат (GCRA, с небольшим запасом на всплески);
+- в один чат одновременно идёт не больше одного запроса, остальные ждут его в порядке
+  постановки, поэтому сообщения чата приходят в том порядке, в каком отправлены;
+- при RetryAfter чат ставится на паузу на указанное время, а сообщение — обратно в очередь;
+- сетевые ошибки повторяются с экспоненциальной задержкой, сообщения не теряются.
+
+QueuedBot подключает очередь прозрачно: message.answer, bot.send_photo и т.п.
+работают как раньше, но идут через Outbox и не ждут отправки — хендлер не стоит
+в очереди за лимитом чата. Где нужен результат (message_id отправленного сообщения),
+вызов оборачивается в wait_sent().
+"""
+
+import asyncio
+import contextvars
+import functools
+import itertools
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Hashable, Optional
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup
+from aiogram.utils.exceptions import MessageNotModified, NetworkError, RetryAfter
+
+from metrics import registry
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 0
+NOTIFICATION = 1
+PRIORITY_NAMES = {INTERACTIVE: "interactive", NOTIFICATION: "notification"}
+
+# Лимиты Telegram: около 30 сообщений в секунду на бота и около 1 в секунду в один чат
+OUTBOX_GLOBAL_RATE = float(os.environ.get("OUTBOX_GLOBAL_RATE", "25"))
+OUTBOX_CHAT_RATE = float(os.environ.get("OUTBOX_CHAT_RATE", "1"))
+OUTBOX_CHAT_BURST = int(os.environ.get("OUTBOX_CHAT_BURST", "3"))
+OUTBOX_WORKERS = int(os.environ.get("OUTBOX_WORKERS", "8"))
+OUTBOX_MAX_RETRIES = int(os.environ.get("OUTBOX_MAX_RETRIES", "5"))
+# Не чаще раза в столько секунд правим клавиатуру одного сообщения; нажатия между правками склеиваются
+EDIT_COALESCE_WINDOW = float(os.environ.get("EDIT_COALESCE_WINDOW", "0.7"))
+
+# Методы Bot API, которые идут через очередь; остальные (answerCallbackQuery, getMe, ...) — напрямую
+QUEUED_METHODS = {"sendMessage", "sendPhoto", "editMessageReplyMarkup", "editMessageText", "editMessageCaption"}
+
+# Приоритет отправок в текущем контексте (см. QueuedBot.notify)
+send_priority = contextvars.ContextVar("send_priority", default=INTERACTIVE)
+# Ждать ли отправки в текущем контексте (см. wait_sent)
+send_wait = contextvars.ContextVar("send_wait", default=False)
+
+@contextmanager
+def wait_sent():
+    """Внутри блока отправки через QueuedBot ждут своей очереди и возвращают настоящий результат."""
+    token = send_wait.set(True)
+    try:
+        yield
+    finally:
+        send_wait.reset(token)
+
+class RateLimiter:
+    """GCRA: не больше rate событий в секунду на ключ, с запасом burst на короткие всплески."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.interval = 1.0 / rate
+        self.tolerance = self.interval * (burst - 1)
+        self._tat = {}
+
+    def reserve(self, key, at: float) -> float:
+        """Занимает ближайший свободный слот не раньше at и возвращает время этого слота."""
+        tat = max(self._tat.get(key, at), at)
+        slot = max(at, tat - self.tolerance)
+        self._tat[key] = max(tat, slot) + self.interval
+        return slot
+
+    def allow(self, key, at: float) -> bool:
+        """Как reserve, но без ожидания: событие проходит, только если слот свободен уже в момент at."""
+        tat = max(self._tat.get(key, at), at)
+        if tat - self.tolerance > at:
+            return False
+        self._tat[key] = tat + self.interval
+        return True
+
+    def pause(self, key, until: float):
+        self._tat[key] = max(self._tat.get(key, 0.0), until + self.tolerance)
+
+    def prune(self, now: float):
+        # Ключи, чей слот уже в прошлом, ничем не отличаются от отсутствующих
+        for key in [k for k, tat in self._tat.items() if tat < now]:
+            del self._tat[key]
+
+class Job:
+    __slots__ = ("factory", "chat_id", "priority", "seq", "future", "created", "attempts", "scheduled")
+
+    def __init__(self, factory, chat_id, priority: int, seq: int, future: asyncio.Future):
+        self.factory = factory
+        self.chat_id = chat_id
+        self.priority = priority
+        self.seq = seq
+        self.future = future
+        self.created = time.monotonic()
+        self.attempts = 0
+        self.scheduled = False
+
+    def __lt__(self, other: "Job"):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+class Outbox:
+    """Приоритетная очередь исходящих запросов с лимитами и повторами."""
+
+    def __init__(self, workers: int = OUTBOX_WORKERS, global_rate: float = OUTBOX_GLOBAL_RATE,
+                 chat_rate: float = OUTBOX_CHAT_RATE, chat_burst: int = OUTBOX_CHAT_BURST,
+                 max_retries: int = OUTBOX_MAX_RETRIES):
+        self.workers = workers
+        self.max_retries = max_retries
+        self._global = RateLimiter(global_rate, burst=max(1, int(global_rate)))
+        self._chats = RateLimiter(chat_rate, burst=chat_burst)
+        self._queue = None
+        # Очереди чатов: пока запрос в чат не отправлен (с повторами) или не провалился,
+        # следующие запросы в тот же чат ждут здесь, чтобы сообщения не обгоняли друг друга
+        self._chat_jobs = {}
+        self._tasks = []
+        self._seq = itertools.count()
+        self._pending = 0
+        self._idle = None
+        self._depth = {INTERACTIVE: 0, NOTIFICATION: 0}
+        self._latencies = deque(maxlen=2000)
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.retry_after = 0
+
+    def _start(self):
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+            self._idle = asyncio.Event()
+            self._idle.set()
+        if not self._tasks:
+            self._tasks = [asyncio.ensure_future(self._worker()) for _ in range(self.workers)]
+
+    def post(self, factory, chat_id=None, priority: int = INTERACTIVE) -> asyncio.Future:
+        """Ставит запрос в очередь и возвращает future с его результатом. factory — функция без аргументов, возвращающая корутину."""
+        self._start()
+        job = Job(factory, chat_id, priority, next(self._seq), asyncio.get_running_loop().create_future())
+        self._pending += 1
+        self._idle.clear()
+        if chat_id is None:
+            self._put(job)
+        elif chat_id in self._chat_jobs:
+            self._chat_jobs[chat_id].append(job)
+        else:
+            self._chat_jobs[chat_id] = deque()
+            self._put(job)
+        return job.future
+
+    async def submit(self, factory, chat_id=None, priority: int = INTERACTIVE):
+        """Ставит запрос в очередь и ждёт результата."""
+        return await self.post(factory, chat_id, priority)
+
+    def _put(self, job: Job):
+        self._depth[job.priority] += 1
+        self._queue.put_nowait(job)
+
+    def _done(self, job: Job):
+        if job.chat_id is not None:
+            waiting = self._chat_jobs[job.chat_id]
+            if waiting:
+                self._put(waiting.popleft())
+            else:
+                del self._chat_jobs[job.chat_id]
+        self._pending -= 1
+        if self._pending == 0:
+            self._idle.set()
+
+    async def _worker(self):
+        while True:
+            job = await self._queue.get()
+            self._depth[job.priority] -= 1
+            try:
+                await self._run(job)
+            except Exception:
+                logger.exception("Сбой очереди отправки")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        loop = asyncio.get_running_loop()
+        if not job.scheduled:
+            # Резервируем слот в лимитах чата и бота; если он в будущем — ждём вне воркера,
+            # чтобы медленный чат не занимал воркеры, нужные другим
+            now = time.monotonic()
+            slot = self._chats.reserve(job.chat_id, now) if job.chat_id is not None else now
+            slot = self._global.reserve(None, slot)
+            job.scheduled = True
+            if slot > now:
+                loop.call_later(slot - now, self._put, job)
+                return
+        try:
+            result = await job.factory()
+        except RetryAfter as e:
+            self.retry_after += 1
+            logger.warning("Flood control для чата %s: пауза %s с", job.chat_id, e.timeout)
+            until = time.monotonic() + e.timeout
+            if job.chat_id is not None:
+                self._chats.pause(job.chat_id, until)
+            else:
+                self._global.pause(None, until)
+            job.scheduled = False
+            self._put(job)
+        except (NetworkError, asyncio.TimeoutError) as e:
+            job.attempts += 1
+            if job.attempts > self.max_retries:
+                self._fail(job, e)
+                return
+            self.retried += 1
+            job.scheduled = False
+            loop.call_later(min(2 ** job.attempts * 0.5, 30), self._put, job)
+        except Exception as e:
+            self._fail(job, e)
+        else:
+            self.sent += 1
+            self._latencies.append(time.monotonic() - job.created)
+            if not job.future.done():
+                job.future.set_result(result)
+            self._done(job)
+            if self.sent % 1000 == 0:
+                self._chats.prune(time.monotonic())
+
+    def _fail(self, job: Job, error: Exception):
+        self.failed += 1
+        if not job.future.done():
+            job.future.set_exception(error)
+        self._done(job)
+
+    def stats(self) -> dict:
+        latencies = sorted(self._latencies)
+
+        def percentile(q):
+            return round(latencies[min(len(latencies) - 1, int(q * len(latencies)))] * 1000, 1) if latencies else 0.0
+
+        return {
+            "queued": {PRIORITY_NAMES[p]: n for p, n in self._depth.items()},
+            "pending": self._pending,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "retry_after": self.retry_after,
+            "latency_p50_ms": percentile(0.5),
+            "latency_p99_ms": percentile(0.99),
+        }
+
+    async def close(self, timeout: float = 10.0):
+        """Дожидается отправки всего, что уже в очереди (не дольше timeout), и останавливает воркеры."""
+        if self._idle is not None and self._pending:
+            try:
+                await asyncio.wait_for(self._idle.wait(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning("Не отправлено при остановке: %s", self.stats())
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+
+class QueuedBot(Bot):
+    """Bot, у которого отправка сообщений идёт через Outbox."""
+
+    def __init__(self, *args, outbox: Optional[Outbox] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.outbox = outbox or Outbox()
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        if method not in QUEUED_METHODS:
+            return await self._timed_request(method, data, files, **kwargs)
+        chat_id = (data or {}).get("chat_id")
+        future = self.outbox.post(lambda: self._timed_request(method, data, files, **kwargs),
+                                  chat_id=chat_id, priority=send_priority.get())
+        if send_wait.get():
+            return await future
+        # Результат никто не ждёт: ошибки только в лог, вызывающему — пустое сообщение
+        # (send*) или True (правки), как будто Telegram уже ответил
+        future.add_done_callback(functools.partial(self._log_failure, method, chat_id))
+        return {} if method.startswith("send") else True
+
+    @staticmethod
+    def _log_failure(method, chat_id, future: asyncio.Future):
+        error = future.exception()
+        if error is not None and not isinstance(error, MessageNotModified):
+            logger.error("Не удалось выполнить %s в чате %s: %s", method, chat_id, error)
+
+    async def _timed_request(self, method, data=None, files=None, **kwargs):
+        # Только сам HTTP-запрос, без ожидания в очереди (оно видно в outbox.stats())
+        started = time.perf_counter()
+        try:
+            return await super().request(method, data, files, **kwargs)
+        except Exception as e:
+            registry.inc("telegram_request_errors_total", method=method, error=type(e).__name__)
+            raise
+        finally:
+            registry.observe("telegram_request_seconds", time.perf_counter() - started, method=method)
+
+    def notify(self, chat_id, text: str, **kwargs) -> asyncio.Task:
+        """Отправляет уведомление в фоне с низким приоритетом; обработчик не ждёт доставки."""
+        async def deliver():
+            send_priority.set(NOTIFICATION)
+            try:
+                with wait_sent():
+                    await self.send_message(chat_id, text, **kwargs)
+            except Exception as e:
+                logger.error("Не удалось доставить уведомление в чат %s: %s", chat_id, e)
+        return asyncio.ensure_future(deliver())
+
+class MarkupCoalescer:
+    """Склеивает частые правки inline-клавиатуры одного сообщения в одну.
+
+    Правка отправляется сразу. Правки, пришедшие, пока предыдущая ещё в очереди или
+    в пути, только подменяют итоговую клавиатуру: она уходит одним запросом после
+    предыдущего, но не раньше чем через window секунд после него. Если итог совпадает
+    с тем, что уже показано (key — любой хэшируемый отпечаток клавиатуры), запрос не отправляется.
+    """
+
+    def __init__(self, bot: Bot, window: float = EDIT_COALESCE_WINDOW, remember_size: int = 10000):
+        self.bot = bot
+        self.window = window
+        self.remember_size = remember_size
+        self._pending = {}
+        self._busy = set()
+        self._shown = OrderedDict()
+        self.edits = 0
+        self.coalesced = 0
+        self.unchanged = 0
+
+    def remember(self, chat_id: int, message_id: int, key: Hashable):
+        """Запоминает, какая клавиатура показана в только что отправленном сообщении."""
+        self._shown[(chat_id, message_id)] = key
+        self._shown.move_to_end((chat_id, message_id))
+        while len(self._shown) > self.remember_size:
+            self._shown.popitem(last=False)
+
+    def send(self, send, key: Hashable) -> asyncio.Task:
+        """Отправляет сообщение с клавиатурой в фоне и запоминает её, когда станет известен message_id.
+
+        send — функция без аргументов, возвращающая корутину отправки (message.answer(...)).
+        """
+        async def deliver():
+            try:
+                with wait_sent():
+                    sent = await send()
+            except Exception as e:
+                logger.error("Не удалось отправить клавиатуру: %s", e)
+                return
+            self.remember(sent.chat.id, sent.message_id, key)
+        return asyncio.ensure_future(deliver())
+
+    def update(self, chat_id: int, message_id: int, markup: InlineKeyboardMarkup, key: Hashable):
+        target = (chat_id, message_id)
+        if target in self._pending:
+            self.coalesced += 1
+        self._pending[target] = (markup, key)
+        if target not in self._busy:
+            self._busy.add(target)
+            asyncio.ensure_future(self._drain(target))
+
+    def cancel(self, chat_id: int, message_id: int):
+        self._pending.pop((chat_id, message_id), None)
+
+    async def _drain(self, target):
+        try:
+            while target in self._pending:
+                started = time.monotonic()
+                await self._flush(target)
+                if target in self._pending:
+                    await asyncio.sleep(max(0.0, self.window - (time.monotonic() - started)))
+        finally:
+            self._busy.discard(target)
+
+    async def _flush(self, target):
+        pending = self._pending.pop(target, None)
+        if pending is None:
+            return
+        markup, key = pending
+        if target in self._shown and self._shown[target] == key:
+            self.unchanged += 1
+            return
+        self.remember(*target, key)
+        self.edits += 1
+        try:
+            with wait_sent():
+                await self.bot.edit_message_reply_markup(*target, reply_markup=markup)
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            self._shown.pop(target, None)
+            logger.error("Не удалось обновить клавиатуру в чате %s: %s", target[0], e)
+
+    def stats(self) -> dict:
+        return {"edits": self.edits, "coalesced": self.coalesced, "unchanged": self.unchanged, "pending": len(self._pending)}
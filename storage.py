@@ -0,0 +1,224 @@
+# coding: utf-8
+
+"""
+Хранилище FSM для aiogram поверх SQLite.
+
+В отличие от MemoryStorage состояние регистрации переживает перезапуск бота,
+а память не растёт вместе с числом брошенных анкет:
+- в памяти держится только ограниченный набор «горячих» записей (LRU);
+- изменения пишутся в базу пачками раз в FSM_FLUSH_INTERVAL секунд (write-behind);
+- записи, которые не менялись дольше FSM_TTL секунд, считаются брошенными и удаляются.
+"""
+
+import asyncio
+import copy
+import json
+import logging
+import os
+import time
+import typing
+from collections import OrderedDict
+
+from aiogram.dispatcher.storage import BaseStorage
+
+import db
+
+logger = logging.getLogger(__name__)
+
+FSM_HOT_SIZE = int(os.environ.get("FSM_HOT_SIZE", "5000"))
+FSM_FLUSH_INTERVAL = float(os.environ.get("FSM_FLUSH_INTERVAL", "1.0"))
+FSM_TTL = float(os.environ.get("FSM_TTL", str(7 * 24 * 3600)))
+# Раз в сколько сбросов чистить просроченные записи в базе
+FSM_PURGE_EVERY = 600
+
+# === Синхронная часть (выполняется в пуле потоков db) ===
+def load_record(chat: int, user: int, min_updated_at: float):
+    cur = db.get_db_connection().cursor()
+    cur.execute("SELECT state, data, bucket FROM fsm WHERE chat = ? AND user = ? AND updated_at >= ?",
+                (chat, user, min_updated_at))
+    row = cur.fetchone()
+    if not row:
+        return None
+    state, data, bucket = row
+    return {"state": state, "data": json.loads(data or "{}"), "bucket": json.loads(bucket or "{}")}
+
+def save_records(records: list):
+    upserts = [(chat, user, r["state"], json.dumps(r["data"], ensure_ascii=False),
+                json.dumps(r["bucket"], ensure_ascii=False), r["updated_at"])
+               for chat, user, r in records if not is_empty(r)]
+    deletes = [(chat, user) for chat, user, r in records if is_empty(r)]
+    with db.transaction() as cur:
+        cur.executemany("""
+            INSERT OR REPLACE INTO fsm (chat, user, state, data, bucket, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, upserts)
+        cur.executemany("DELETE FROM fsm WHERE chat = ? AND user = ?", deletes)
+
+def purge_expired(min_updated_at: float) -> int:
+    with db.transaction() as cur:
+        cur.execute("DELETE FROM fsm WHERE updated_at < ?", (min_updated_at,))
+        return cur.rowcount
+
+def is_empty(record: dict) -> bool:
+    return record["state"] is None and not record["data"] and not record["bucket"]
+
+def new_record() -> dict:
+    return {"state": None, "data": {}, "bucket": {}, "updated_at": time.time()}
+
+# === Хранилище ===
+class SQLiteStorage(BaseStorage):
+    """FSM-хранилище aiogram с отложенной записью в SQLite и ограниченным кэшем в памяти."""
+
+    def __init__(self, database: db.Database = None, hot_size: int = FSM_HOT_SIZE,
+                 flush_interval: float = FSM_FLUSH_INTERVAL, ttl: float = FSM_TTL):
+        self.database = database or db.db
+        self.hot_size = hot_size
+        self.flush_interval = flush_interval
+        self.ttl = ttl
+        self._hot = OrderedDict()
+        self._dirty = set()
+        self._saving = set()
+        self._flusher = None
+        self._closed = False
+        self._flush_lock = asyncio.Lock()
+        self._flushes = 0
+
+    @staticmethod
+    def _key(chat, user) -> typing.Tuple[int, int]:
+        chat, user = BaseStorage.check_address(chat=chat, user=user)
+        return int(chat), int(user)
+
+    def _expired(self, record: dict) -> bool:
+        return record["updated_at"] < time.time() - self.ttl
+
+    async def _record(self, chat, user) -> dict:
+        key = self._key(chat, user)
+        record = self._hot.get(key)
+        if record is not None and self._expired(record) and key not in self._dirty:
+            record = None
+            del self._hot[key]
+        if record is None:
+            loaded = await self.database.run(load_record, *key, time.time() - self.ttl)
+            # Пока шла загрузка, запись могли создать конкурентно — она свежее
+            record = self._hot.get(key)
+            if record is None:
+                record = new_record()
+                if loaded:
+                    record.update(loaded)
+                self._hot[key] = record
+        self._hot.move_to_end(key)
+        self._evict()
+        return record
+
+    def _touch(self, chat, user, record: dict):
+        key = self._key(chat, user)
+        record["updated_at"] = time.time()
+        self._dirty.add(key)
+        self._ensure_flusher()
+
+    def _evict(self):
+        # Вытесняем только чистые записи: грязные сначала должны попасть в базу
+        if len(self._hot) <= self.hot_size:
+            return
+        for key in list(self._hot):
+            if len(self._hot) <= self.hot_size:
+                break
+            if key not in self._dirty and key not in self._saving:
+                del self._hot[key]
+
+    def _ensure_flusher(self):
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_loop())
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Не удалось сохранить состояния FSM")
+
+    async def flush(self):
+        async with self._flush_lock:
+            if self._dirty:
+                keys, self._dirty = self._dirty, set()
+                self._saving = keys
+                records = [(chat, user, copy.deepcopy(self._hot[(chat, user)])) for chat, user in keys]
+                try:
+                    await self.database.run(save_records, records)
+                except Exception:
+                    self._dirty |= keys
+                    raise
+                finally:
+                    self._saving = set()
+                self._evict()
+            self._flushes += 1
+            if self._flushes % FSM_PURGE_EVERY == 0:
+                purged = await self.database.run(purge_expired, time.time() - self.ttl)
+                if purged:
+                    logger.info("Удалено брошенных состояний FSM: %s", purged)
+
+    def stats(self) -> dict:
+        return {"hot": len(self._hot), "dirty": len(self._dirty)}
+
+    async def close(self):
+        # Вызывается и из on_shutdown (пока пул db ещё жив), и потом из executor aiogram
+        if self._closed:
+            return
+        self._closed = True
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        await self.flush()
+
+    async def wait_closed(self):
+        pass
+
+    # === Интерфейс BaseStorage ===
+    async def get_state(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                        default: typing.Optional[str] = None) -> typing.Optional[str]:
+        record = await self._record(chat, user)
+        return record["state"] if record["state"] is not None else self.resolve_state(default)
+
+    async def get_data(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                       default: typing.Optional[typing.Dict] = None) -> typing.Dict:
+        record = await self._record(chat, user)
+        return copy.deepcopy(record["data"]) if record["data"] else (default or {})
+
+    async def set_state(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                        state: typing.AnyStr = None):
+        record = await self._record(chat, user)
+        record["state"] = self.resolve_state(state)
+        self._touch(chat, user, record)
+
+    async def set_data(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                       data: typing.Dict = None):
+        record = await self._record(chat, user)
+        record["data"] = copy.deepcopy(data or {})
+        self._touch(chat, user, record)
+
+    async def update_data(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                          data: typing.Dict = None, **kwargs):
+        record = await self._record(chat, user)
+        record["data"].update(copy.deepcopy(data or {}), **copy.deepcopy(kwargs))
+        self._touch(chat, user, record)
+
+    def has_bucket(self):
+        return True
+
+    async def get_bucket(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                         default: typing.Optional[dict] = None) -> typing.Dict:
+        record = await self._record(chat, user)
+        return copy.deepcopy(record["bucket"]) if record["bucket"] else (default or {})
+
+    async def set_bucket(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                         bucket: typing.Dict = None):
+        record = await self._record(chat, user)
+        record["bucket"] = copy.deepcopy(bucket or {})
+        self._touch(chat, user, record)
+
+    async def update_bucket(self, *, chat: typing.Union[str, int, None] = None, user: typing.Union[str, int, None] = None,
+                            bucket: typing.Dict = None, **kwargs):
+        record = await self._record(chat, user)
+        record["bucket"].update(copy.deepcopy(bucket or {}), **copy.deepcopy(kwargs))
+        self._touch(chat, user, record)
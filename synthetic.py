@@ -0,0 +1,96 @@
+# coding: utf-8
+
+"""
+Синтетические пользователи и поддельный Bot API — общие для bench.py и webhook_harness.py.
+
+Обновления строятся словарями в формате Bot API: webhook_harness шлёт их POST-запросом
+в webhook бота, bench оборачивает в types.Update и отдаёт диспетчеру напрямую.
+FakeTelegram отвечает на вызовы Bot API правдоподобным результатом, считает их
+и запоминает последнюю карточку в каждом чате, чтобы свайп нажимал её кнопки.
+
+Модуль не импортирует db и bot: bench выставляет их настройки в окружении до импорта.
+"""
+
+import itertools
+import re
+import time
+from collections import Counter
+
+FACULTIES = ["Финансовый факультет", "Экономический факультет", "IT-факультет", "Юридический факультет", "Менеджмент"]
+# Кнопка лайка на карточке кандидата: like||<id кандидата>
+CARD_ID = re.compile(r"like\|\|(\d+)")
+# Методы, в ответ на которые Telegram присылает отправленное (изменённое) сообщение
+MESSAGE_METHODS = {"sendMessage", "sendPhoto", "editMessageReplyMarkup", "editMessageText", "editMessageCaption"}
+
+# === Обновления ===
+class Updates:
+    """Строит обновления со сквозной нумерацией update_id и message_id."""
+
+    def __init__(self):
+        self._ids = itertools.count(1)
+
+    def message(self, tg_id: int, text: str = None, photo: bool = False) -> dict:
+        message = {"message_id": next(self._ids), "date": int(time.time()),
+                   "chat": {"id": tg_id, "type": "private"},
+                   "from": {"id": tg_id, "is_bot": False, "first_name": f"user{tg_id}"}}
+        if photo:
+            message["photo"] = [{"file_id": f"photo-{tg_id}", "file_unique_id": f"u{tg_id}", "width": 640, "height": 640}]
+        else:
+            message["text"] = text
+            if text.startswith("/"):
+                message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": next(self._ids), "message": message}
+
+    def callback(self, tg_id: int, data: str, message_id: int = 1) -> dict:
+        return {"update_id": next(self._ids), "callback_query": {
+            "id": str(next(self._ids)), "chat_instance": str(tg_id), "data": data,
+            "from": {"id": tg_id, "is_bot": False, "first_name": f"user{tg_id}"},
+            "message": {"message_id": message_id, "date": int(time.time()),
+                        "chat": {"id": tg_id, "type": "private"}, "text": ""},
+        }}
+
+def registration(updates: Updates, rng, tg_id: int, choose_interests) -> list:
+    """Анкета регистрации; choose_interests(rng) возвращает названия выбранных интересов."""
+    script = [updates.message(tg_id, "/start"), updates.message(tg_id, f"Студент {tg_id}"),
+              updates.message(tg_id, str(rng.randint(17, 25))), updates.message(tg_id, rng.choice(FACULTIES)),
+              updates.message(tg_id, str(rng.randint(1, 4))), updates.message(tg_id, photo=True)]
+    script += [updates.callback(tg_id, f"toggle_interest||{name}") for name in choose_interests(rng)]
+    script.append(updates.callback(tg_id, "interests_done"))
+    return script
+
+def swiping(updates: Updates, rng, cards: dict, tg_id: int, swipes: int, actions=("like", "skip")) -> list:
+    # Нажатие строится в момент отправки по карточке, которую бот показал последней (cards)
+    def swipe(action):
+        return lambda: updates.callback(tg_id, f"{action}||{cards.get(tg_id, '')}")
+    script = [updates.message(tg_id, "/find")]
+    script += [swipe(rng.choice(actions)) for _ in range(swipes)]
+    return script
+
+# === Поддельный Bot API ===
+class FakeTelegram:
+    """Отвечает на любые методы Bot API, считает вызовы и запоминает последнюю карточку в каждом чате."""
+
+    def __init__(self):
+        self.calls = Counter()
+        self.cards = {}
+        self._ids = itertools.count(1)
+
+    def call(self, method: str, data=None):
+        self.calls[method] += 1
+        card = CARD_ID.search(str((data or {}).get("reply_markup") or ""))
+        if card:
+            self.cards[int(data["chat_id"])] = card.group(1)
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "UniFriends55", "username": "unifriends55_bot"}
+        if method in MESSAGE_METHODS:
+            return {"message_id": next(self._ids), "date": int(time.time()),
+                    "chat": {"id": int((data or {}).get("chat_id") or 0), "type": "private"}, "text": ""}
+        return True
+
+    async def request(self, method, data=None, files=None, **kwargs):
+        """Подменяет Bot.request: бот не ходит в сеть."""
+        return self.call(method, data)
+
+def percentile(values, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
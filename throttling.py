@@ -0,0 +1,141 @@
+# coding: utf-8
+
+"""
+Ограничение частоты действий одного пользователя.
+
+ThrottlingMiddleware срабатывает до фильтров и хендлеров, поэтому лишнее нажатие
+стоит одного ответа, а не ранжирования, записи в базу и новой карточки:
+- повторное нажатие той же кнопки того же сообщения, пока первое ещё обрабатывается
+  или только что обработано (THROTTLE_DEDUP_WINDOW), склеивается с первым: callback
+  получает пустой ответ, хендлер не вызывается;
+- действия сверх лимита (THROTTLE_LIMITS) отбрасываются: на callback отвечаем
+  «не так быстро», на сообщение — тем же текстом, но не чаще раза в WARN_INTERVAL.
+
+Состояние хранится в памяти процесса. В режиме нескольких процессов (workers.py)
+все обновления пользователя приходят в один процесс, так что лимиты остаются
+персональными.
+"""
+
+import logging
+import os
+import time
+from collections import Counter, OrderedDict
+
+from aiogram import types
+from aiogram.dispatcher.handler import CancelHandler
+from aiogram.dispatcher.middlewares import BaseMiddleware
+
+from metrics import current_update, registry
+from sender import RateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Лимиты «действие=событий_в_секунду/запас» через запятую; пустая строка — без лимитов.
+# Действие — команда без «/» (find), префикс callback_data до «||» (like) или «*» для остального.
+THROTTLE_LIMITS = os.environ.get("THROTTLE_LIMITS", "find=0.5/3,like=2/5,skip=2/5,report=0.2/2,matches=2/5,*=5/20")
+# Сколько секунд после обработки повторное нажатие той же кнопки считается дублем (0 — не склеивать)
+THROTTLE_DEDUP_WINDOW = float(os.environ.get("THROTTLE_DEDUP_WINDOW", "2"))
+# Не чаще чем раз в столько секунд отвечаем текстом на отброшенные сообщения
+WARN_INTERVAL = 5.0
+# Раз в сколько секунд забывать пользователей, которые давно ничего не делали
+PRUNE_INTERVAL = 60.0
+SLOW_DOWN_TEXT = "Не так быстро 🙂 Подожди пару секунд."
+
+def parse_limits(spec: str) -> dict:
+    """"find=0.5/3,*=5/20" -> {"find": (0.5, 3), "*": (5.0, 20)}"""
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        action, _, limit = item.partition("=")
+        rate, _, burst = limit.partition("/")
+        try:
+            rate, burst = float(rate), int(burst or 1)
+        except ValueError:
+            rate = burst = 0
+        if rate <= 0 or burst < 1:
+            raise ValueError(f"Некорректный лимит {item!r}: ожидается действие=событий_в_секунду/запас")
+        limits[action.strip()] = (rate, burst)
+    return limits
+
+class ThrottlingMiddleware(BaseMiddleware):
+    """Персональные лимиты на команды и кнопки плюс склейка повторных нажатий.
+
+    repeatable — действия callback, повтор которых осмыслен (переключатели), их не склеиваем.
+    """
+
+    def __init__(self, limits: dict = None, dedup_window: float = THROTTLE_DEDUP_WINDOW, repeatable=()):
+        super().__init__()
+        limits = parse_limits(THROTTLE_LIMITS) if limits is None else limits
+        self.limiters = {action: RateLimiter(rate, burst) for action, (rate, burst) in limits.items()}
+        self.dedup_window = dedup_window
+        self.repeatable = set(repeatable)
+        self._warnings = RateLimiter(1.0 / WARN_INTERVAL)
+        self._in_flight = set()
+        # Ключ нажатия -> до какого момента повтор считается дублем; окно одно, поэтому порядок = порядок истечения
+        self._recent = OrderedDict()
+        self._pruned = time.monotonic()
+        self.dropped = Counter()
+        self.merged = Counter()
+
+    async def on_pre_process_message(self, message: types.Message, data: dict):
+        action = message.get_command(pure=True) or "*"
+        now = time.monotonic()
+        if self._allow(message.from_user.id, action, now):
+            return
+        self._reject(self.dropped, action, "rate")
+        if self._warnings.allow(message.from_user.id, now):
+            await message.answer(SLOW_DOWN_TEXT)
+        raise CancelHandler()
+
+    async def on_pre_process_callback_query(self, callback: types.CallbackQuery, data: dict):
+        action = (callback.data or "").split("||", 1)[0]
+        now = time.monotonic()
+        key = None
+        if self.dedup_window > 0 and action not in self.repeatable:
+            message_id = callback.message.message_id if callback.message else callback.inline_message_id
+            key = (callback.from_user.id, message_id, callback.data)
+            if key in self._in_flight or self._recent.get(key, 0.0) > now:
+                self._reject(self.merged, action, "duplicate")
+                await callback.answer()
+                raise CancelHandler()
+        if not self._allow(callback.from_user.id, action, now):
+            self._reject(self.dropped, action, "rate")
+            await callback.answer(SLOW_DOWN_TEXT)
+            raise CancelHandler()
+        if key is not None:
+            self._in_flight.add(key)
+            data["throttle_key"] = key
+
+    async def on_post_process_callback_query(self, callback: types.CallbackQuery, results, data: dict):
+        key = data.get("throttle_key")
+        if key is not None:
+            self._in_flight.discard(key)
+            self._recent.pop(key, None)
+            self._recent[key] = time.monotonic() + self.dedup_window
+
+    def _allow(self, user_id: int, action: str, now: float) -> bool:
+        self._prune(now)
+        limiter = self.limiters.get(action) or self.limiters.get("*")
+        return limiter is None or limiter.allow(user_id, now)
+
+    def _reject(self, counter: Counter, action: str, reason: str):
+        counter[action] += 1
+        registry.inc("throttled_updates_total", action=action, reason=reason)
+        # В метриках обновление попадает под хендлер throttled, а не unhandled
+        timer = current_update.get()
+        if timer is not None:
+            timer.handler = "throttled"
+
+    def _prune(self, now: float):
+        while self._recent and next(iter(self._recent.values())) <= now:
+            self._recent.popitem(last=False)
+        if now - self._pruned < PRUNE_INTERVAL:
+            return
+        self._pruned = now
+        for limiter in self.limiters.values():
+            limiter.prune(now)
+        self._warnings.prune(now)
+
+    def stats(self) -> dict:
+        return {"dropped": sum(self.dropped.values()), "merged": sum(self.merged.values()),
+                "dropped_by_action": dict(self.dropped), "merged_by_action": dict(self.merged),
+                "in_flight": len(self._in_flight), "recent": len(self._recent)}
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"""
+Локальный стенд для режима webhook.
+
+Поднимает поддельный Bot API (отвечает «ok» на любой метод и считает вызовы),
+при --spawn запускает сам бот в режиме webhook с временной базой и шлёт ему
+POST-запросы с синтетическими обновлениями: регистрация, /find, лайки и пропуски.
+В конце печатает задержку обработки (от отправки обновления до ответа webhook).
+
+    python webhook_harness.py --spawn --users 200
+    python webhook_harness.py --spawn --users 200 --workers 4   # приёмник и 4 процесса-обработчика
+    python webhook_harness.py --url http://127.0.0.1:8080/webhook   # бот уже запущен с TELEGRAM_API_URL
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import aiohttp
+from aiohttp import web
+from yarl import URL
+
+from db import INTERESTS
+from synthetic import FakeTelegram, Updates, percentile, registration, swiping
+
+FAKE_TOKEN = "123456:HARNESS"
+
+def user_script(updates: Updates, tg_id: int, swipes: int, cards: dict) -> list:
+    def choose_interests(rng):
+        return rng.sample(INTERESTS, rng.randint(1, 5))
+    return registration(updates, random, tg_id, choose_interests) + swiping(updates, random, cards, tg_id, swipes)
+
+# === Поддельный Bot API ===
+class FakeTelegramAPI(FakeTelegram):
+    """FakeTelegram за HTTP-сервером: бот ходит в него через TELEGRAM_API_URL."""
+
+    def __init__(self):
+        super().__init__()
+        self.app = web.Application()
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+
+    async def handle(self, request: web.Request):
+        result = self.call(request.match_info["method"], await request.post())
+        return web.json_response({"ok": True, "result": result})
+
+# === Нагрузка ===
+async def wait_for_port(url: str, timeout: float = 20.0):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                async with session.get(url):
+                    return
+            except aiohttp.ClientError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"Бот не поднялся на {url}")
+
+async def run_load(url: str, users: int, swipes: int, concurrency: int, api: FakeTelegramAPI, secret: str = ""):
+    latencies = []
+    errors = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+    headers = {"X-Telegram-Bot-Api-Secret-Token": secret} if secret else {}
+    first_id = random.randint(10 ** 6, 10 ** 9)
+    updates = Updates()
+
+    async def play(session, tg_id):
+        # Обновления одного пользователя идут строго по порядку, разные пользователи — параллельно
+        async with semaphore:
+            for update in user_script(updates, tg_id, swipes, api.cards):
+                if callable(update):
+                    update = update()
+                started = time.perf_counter()
+                async with session.post(url, json=update, headers=headers) as response:
+                    await response.read()
+                    if response.status != 200:
+                        errors[response.status] += 1
+                latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(play(session, first_id + i) for i in range(users)))
+    return latencies, errors, time.perf_counter() - started
+
+async def wait_for_drain(metrics_url: str, workers: int, timeout: float = 120.0):
+    # Webhook отвечает раньше, чем уходят ответы пользователю (они ждут в очереди отправки),
+    # а при WORKERS > 1 — сразу после передачи обновления обработчику: ждём по /metrics,
+    # пока процессы-обработчики доработают всё, что им отправлено, и очереди отправки опустеют
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            async with session.get(metrics_url) as response:
+                text = await response.text()
+            totals = Counter()
+            for line in text.splitlines():
+                if line.startswith("#"):
+                    continue
+                name, value = line.partition("{")[0].split(" ")[0], line.rsplit(" ", 1)[-1]
+                totals[name] += float(value)
+            pending = totals["outbox_pending"] + totals["worker_outbox_pending"]
+            if workers > 1:
+                pending += totals["worker_updates_dispatched"] - totals["worker_updates_processed"]
+            if not pending and (workers == 1 or totals["worker_updates_dispatched"]):
+                return
+            await asyncio.sleep(0.2)
+    raise RuntimeError("Бот не успел доработать очередь")
+
+def report(latencies, errors, elapsed, api: FakeTelegramAPI):
+    print(f"Обновлений: {len(latencies)} за {elapsed:.2f} с ({len(latencies) / elapsed:.1f} в секунду)")
+    if latencies:
+        ms = [x * 1000 for x in latencies]
+        print(f"Задержка, мс: p50={percentile(ms, 0.5):.1f} p90={percentile(ms, 0.9):.1f} "
+              f"p99={percentile(ms, 0.99):.1f} max={max(ms):.1f} mean={statistics.mean(ms):.1f}")
+    if errors:
+        print(f"Ошибки HTTP: {dict(errors)}")
+    print(f"Вызовы Bot API: {dict(api.calls)}")
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд для webhook-режима UniFriends55")
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook", help="адрес webhook бота")
+    parser.add_argument("--api-port", type=int, default=8081, help="порт поддельного Bot API")
+    parser.add_argument("--spawn", action="store_true", help="запустить бот в режиме webhook с временной базой")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--swipes", type=int, default=10, help="лайков/пропусков на пользователя")
+    parser.add_argument("--concurrency", type=int, default=20, help="сколько пользователей активны одновременно")
+    parser.add_argument("--secret", default="", help="WEBHOOK_SECRET бота")
+    parser.add_argument("--workers", type=int, default=1, help="WORKERS бота (при --spawn)")
+    parser.add_argument("--seed", type=int, default=55)
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    api = FakeTelegramAPI()
+    runner = web.AppRunner(api.app)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.api_port).start()
+
+    process = None
+    tmp = tempfile.TemporaryDirectory()
+    try:
+        if args.spawn:
+            port = URL(args.url).port
+            env = dict(os.environ, BOT_TOKEN=FAKE_TOKEN, RUN_MODE="webhook", PORT=str(port),
+                       WEBAPP_HOST="127.0.0.1", WEBHOOK_HOST=f"http://127.0.0.1:{port}",
+                       WEBHOOK_PATH=URL(args.url).path, WEBHOOK_SECRET=args.secret,
+                       TELEGRAM_API_URL=f"http://127.0.0.1:{args.api_port}",
+                       WORKERS=str(args.workers), WORKER_REPORT_INTERVAL="0.2",
+                       # Синтетические пользователи жмут быстрее живых, а все их карточки приходят
+                       # с одним message_id: ни лимиты частоты, ни склейка повторов не мешают замеру
+                       THROTTLE_LIMITS=os.environ.get("THROTTLE_LIMITS", ""),
+                       THROTTLE_DEDUP_WINDOW=os.environ.get("THROTTLE_DEDUP_WINDOW", "0"),
+                       DB_PATH=os.path.join(tmp.name, "harness.db"))
+            process = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), "bot.py")], env=env)
+            await wait_for_port(args.url)
+        latencies, errors, elapsed = await run_load(args.url, args.users, args.swipes, args.concurrency, api, args.secret)
+        started = time.perf_counter()
+        await wait_for_drain(str(URL(args.url).with_path("/metrics")), args.workers)
+        print(f"Задержка ниже — ответ webhook; очереди доработали ещё за {time.perf_counter() - started:.2f} с")
+        elapsed += time.perf_counter() - started
+        report(latencies, errors, elapsed, api)
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+        await runner.cleanup()
+        tmp.cleanup()
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,358 @@
+# coding: utf-8
+
+"""
+Многопроцессный режим: один приёмник обновлений и WORKERS процессов-обработчиков.
+
+Приёмник (webhook или polling) обновления не разбирает: по from.id сырого обновления
+выбирает процесс (user_id % WORKERS) и кладёт обновление в его очередь. Все обновления
+одного пользователя попадают в один процесс и обрабатываются там строго по очереди
+(UserSerializer), поэтому его FSM, буфер показов и правки клавиатур живут в одном месте.
+Разные пользователи обрабатываются параллельно — и в разных процессах, и внутри одного.
+
+Процессы делят одну базу SQLite: WAL, busy_timeout и транзакции BEGIN IMMEDIATE
+(см. db.py) рассчитаны на нескольких писателей. Кэш профилей у каждого процесса свой,
+поэтому инвалидации пересылаются остальным процессам через приёмник.
+
+Обработчики раз в WORKER_REPORT_INTERVAL секунд присылают свою нагрузку; приёмник
+пишет сводку в лог и отдаёт её в /metrics (worker_* с меткой worker).
+"""
+
+import asyncio
+import functools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from aiogram import Bot, Dispatcher, types
+from aiohttp import web
+
+import db
+import metrics
+from metrics import format_labels, registry
+
+logger = logging.getLogger(__name__)
+
+# Раз в сколько секунд обработчики присылают нагрузку, а приёмник пишет сводку в лог
+WORKER_REPORT_INTERVAL = float(os.environ.get("WORKER_REPORT_INTERVAL", "10"))
+# Таймаут long polling у приёмника в режиме polling
+POLL_TIMEOUT = int(os.environ.get("POLL_TIMEOUT", "20"))
+# Сколько сообщений обработчик забирает из очереди за один переход в поток
+INBOX_BATCH = 100
+
+def update_user_id(update: dict) -> int:
+    # У message, callback_query, inline_query и остальных типов пользователь лежит в from;
+    # у обновлений без автора (channel_post, poll) шардируем по чату
+    for value in update.values():
+        if isinstance(value, dict):
+            author = value.get("from") or value.get("chat")
+            if author:
+                return author.get("id", 0)
+    return 0
+
+# === Процесс-обработчик ===
+class UserSerializer:
+    """Обновления одного пользователя выполняются строго по порядку, разных — параллельно."""
+
+    def __init__(self):
+        self._tails = {}
+
+    def __len__(self):
+        return len(self._tails)
+
+    def submit(self, user_id: int, run) -> asyncio.Task:
+        task = asyncio.ensure_future(self._after(self._tails.get(user_id), run))
+        self._tails[user_id] = task
+        task.add_done_callback(functools.partial(self._forget, user_id))
+        return task
+
+    @staticmethod
+    async def _after(previous, run):
+        if previous is not None:
+            # Ошибка предыдущего обновления не отменяет следующее
+            await asyncio.wait([previous])
+        return await run()
+
+    def _forget(self, user_id: int, task: asyncio.Task):
+        if self._tails.get(user_id) is task:
+            del self._tails[user_id]
+
+    async def drain(self):
+        while self._tails:
+            await asyncio.wait(list(self._tails.values()))
+
+class Worker:
+    def __init__(self, dp: Dispatcher, index: int, inbox, reports):
+        self.dp = dp
+        self.index = index
+        self.inbox = inbox
+        self.reports = reports
+        self.serializer = UserSerializer()
+        self.received = 0
+        self.processed = 0
+        self.errors = 0
+
+    async def run(self, on_startup=None, on_shutdown=None):
+        Bot.set_current(self.dp.bot)
+        Dispatcher.set_current(self.dp)
+        self.dp["worker"] = self.index
+        db.profile_cache.listeners.append(self._invalidated)
+        if on_startup:
+            await on_startup(self.dp)
+        reporter = asyncio.ensure_future(self._report_loop())
+        logger.info("Обработчик %s запущен (pid %s)", self.index, os.getpid())
+        try:
+            await self._consume()
+            await self.serializer.drain()
+        finally:
+            reporter.cancel()
+            self._report()
+            if on_shutdown:
+                await on_shutdown(self.dp)
+
+    async def _consume(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            for item in await loop.run_in_executor(None, self._take):
+                if item is None:
+                    return
+                kind, payload = item
+                if kind == "update":
+                    self.received += 1
+                    self.serializer.submit(update_user_id(payload), functools.partial(self._process, payload))
+                elif kind == "invalidate":
+                    db.profile_cache.invalidate(user_id=payload, notify=False)
+
+    def _take(self) -> list:
+        items = [self.inbox.get()]
+        while len(items) < INBOX_BATCH and items[-1] is not None:
+            try:
+                items.append(self.inbox.get_nowait())
+            except queue.Empty:
+                break
+        return items
+
+    async def _process(self, payload: dict):
+        try:
+            await self.dp.updates_handler.notify(types.Update(**payload))
+        except Exception:
+            self.errors += 1
+            logger.exception("Обработчик %s: сбой на обновлении %s", self.index, payload.get("update_id"))
+        finally:
+            self.processed += 1
+
+    def _invalidated(self, user_id: int):
+        # Вызывается из потока пула базы; очередь multiprocessing потокобезопасна
+        self.reports.put(("invalidate", self.index, user_id))
+
+    def _report(self):
+        self.reports.put(("load", self.index, {
+            "received": self.received,
+            "processed": self.processed,
+            "errors": self.errors,
+            "busy_users": len(self.serializer),
+            "outbox_pending": self.dp.bot.outbox.stats()["pending"],
+            "cpu_seconds": time.process_time(),
+        }))
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(WORKER_REPORT_INTERVAL)
+            self._report()
+
+def serve(dp: Dispatcher, index: int, inbox, reports, on_startup=None, on_shutdown=None):
+    """Тело процесса-обработчика. Останавливается, получив None из inbox."""
+    # Ctrl+C приходит всей группе процессов; обработчики дорабатывают очередь по команде приёмника
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(Worker(dp, index, inbox, reports).run(on_startup, on_shutdown))
+
+# === Приёмник ===
+class FrontEnd:
+    """Запускает обработчики, раскладывает по ним обновления и собирает их нагрузку.
+
+    target(index, inbox, reports) — функция процесса-обработчика; она должна быть
+    доступна по имени модуля, так как процессы запускаются через spawn.
+    """
+
+    def __init__(self, target, count: int):
+        self.target = target
+        self.count = count
+        self._context = multiprocessing.get_context("spawn")
+        self.inboxes = [self._context.Queue() for _ in range(count)]
+        self.reports = self._context.Queue()
+        self.processes = [None] * count
+        self.dispatched = [0] * count
+        # Накопленное за все жизни процесса и последний отчёт текущей
+        self.received = [0] * count
+        self.processed = [0] * count
+        self.cpu_seconds = [0.0] * count
+        self.loads = [{} for _ in range(count)]
+        self._described = (time.monotonic(), [0] * count, [0.0] * count)
+        self._reader = None
+        self._stopping = False
+        registry.add_collector(self.collect)
+
+    def start(self):
+        for index in range(self.count):
+            self._spawn(index)
+        self._reader = asyncio.ensure_future(self._read_reports())
+
+    def _spawn(self, index: int):
+        process = self._context.Process(target=self.target, args=(index, self.inboxes[index], self.reports),
+                                        name=f"worker-{index}")
+        process.start()
+        self.processes[index] = process
+        self.loads[index] = {}
+
+    def route(self, update: dict):
+        index = update_user_id(update) % self.count
+        self.inboxes[index].put(("update", update))
+        self.dispatched[index] += 1
+
+    # --- Отчёты обработчиков ---
+    async def _read_reports(self):
+        loop = asyncio.get_running_loop()
+        logged = time.monotonic()
+        while not self._stopping:
+            message = await loop.run_in_executor(None, self._next_report)
+            if message is not None:
+                self._handle(*message)
+            self._check_alive()
+            if time.monotonic() - logged >= WORKER_REPORT_INTERVAL:
+                logged = time.monotonic()
+                logger.info("Нагрузка обработчиков: %s", self.describe())
+
+    def _next_report(self):
+        try:
+            return self.reports.get(timeout=1.0)
+        except queue.Empty:
+            return None
+
+    def _handle(self, kind: str, index: int, payload):
+        if kind == "invalidate":
+            for other, inbox in enumerate(self.inboxes):
+                if other != index:
+                    inbox.put(("invalidate", payload))
+        elif kind == "load":
+            previous = self.loads[index]
+            self.received[index] += payload["received"] - previous.get("received", 0)
+            self.processed[index] += payload["processed"] - previous.get("processed", 0)
+            self.cpu_seconds[index] += payload["cpu_seconds"] - previous.get("cpu_seconds", 0.0)
+            errors = payload["errors"] - previous.get("errors", 0)
+            if errors:
+                registry.inc("worker_errors_total", errors, worker=index)
+            self.loads[index] = payload
+
+    def _check_alive(self):
+        for index, process in enumerate(self.processes):
+            if not self._stopping and process.exitcode is not None:
+                # Обновления, которые процесс успел забрать из очереди, потеряны; остальные дождутся нового
+                logger.error("Обработчик %s завершился с кодом %s, перезапускаю", index, process.exitcode)
+                registry.inc("worker_restarts_total", worker=index)
+                self._spawn(index)
+
+    def collect(self) -> dict:
+        values = {}
+        for index in range(self.count):
+            labels = format_labels((("worker", index),))
+            values["worker_updates_dispatched" + labels] = self.dispatched[index]
+            values["worker_updates_processed" + labels] = self.processed[index]
+            values["worker_queue_backlog" + labels] = self.dispatched[index] - self.received[index]
+            values["worker_busy_users" + labels] = self.loads[index].get("busy_users", 0)
+            values["worker_outbox_pending" + labels] = self.loads[index].get("outbox_pending", 0)
+            values["worker_cpu_seconds" + labels] = round(self.cpu_seconds[index], 3)
+            values["worker_alive" + labels] = int(self.processes[index] is not None and self.processes[index].is_alive())
+        return values
+
+    def describe(self) -> str:
+        # Обновлений в секунду и загрузка CPU с прошлой сводки, плюс очередь на входе
+        now = time.monotonic()
+        since, processed, cpu = self._described
+        elapsed = max(now - since, 1e-9)
+        parts = []
+        for index in range(self.count):
+            rate = (self.processed[index] - processed[index]) / elapsed
+            load = (self.cpu_seconds[index] - cpu[index]) / elapsed * 100
+            parts.append(f"#{index}: {rate:.1f} обн/с, CPU {load:.0f}%, очередь {self.dispatched[index] - self.received[index]}")
+        self._described = (now, list(self.processed), list(self.cpu_seconds))
+        return "; ".join(parts)
+
+    async def stop(self, timeout: float = 30.0):
+        self._stopping = True
+        for inbox in self.inboxes:
+            inbox.put(None)
+        loop = asyncio.get_running_loop()
+        for index, process in enumerate(self.processes):
+            await loop.run_in_executor(None, process.join, timeout)
+            if process.exitcode is None:
+                logger.warning("Обработчик %s не остановился за %s с, завершаю принудительно", index, timeout)
+                process.terminate()
+        if self._reader is not None:
+            await self._reader
+        # Финальные отчёты обработчиков
+        while (message := self._next_report_nowait()) is not None:
+            self._handle(*message)
+        for inbox in self.inboxes + [self.reports]:
+            inbox.cancel_join_thread()
+        logger.info("Итог по обработчикам: отправлено %s, обработано %s", self.dispatched, self.processed)
+
+    def _next_report_nowait(self):
+        try:
+            return self.reports.get_nowait()
+        except queue.Empty:
+            return None
+
+# === Приём обновлений ===
+def webhook_app(front: FrontEnd, path: str, middlewares=()) -> web.Application:
+    """Webhook приёмника: обновление только кладётся в очередь, ответ Telegram — сразу."""
+    async def receive(request: web.Request):
+        front.route(await request.json())
+        return web.Response()
+
+    app = web.Application(middlewares=list(middlewares))
+    app.router.add_post(path, receive)
+    metrics.setup_routes(app)
+    return app
+
+async def poll(bot: Bot, front: FrontEnd, skip_updates: bool = True):
+    # Сырой getUpdates: приёмнику не нужны объекты aiogram, обновления уходят в обработчики как есть
+    offset = None
+    if skip_updates:
+        pending = await bot.request("getUpdates", {"offset": -1, "timeout": 0})
+        if pending:
+            offset = pending[-1]["update_id"] + 1
+    while True:
+        payload = {"timeout": POLL_TIMEOUT}
+        if offset is not None:
+            payload["offset"] = offset
+        try:
+            updates = await bot.request("getUpdates", payload)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            logger.exception("getUpdates не удался, повтор через секунду")
+            await asyncio.sleep(1)
+            continue
+        for update in updates:
+            front.route(update)
+            offset = update["update_id"] + 1
+
+def run_polling(bot: Bot, front: FrontEnd, on_startup=None, on_shutdown=None):
+    async def main():
+        if on_startup:
+            await on_startup()
+        polling = asyncio.ensure_future(poll(bot, front))
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, polling.cancel)
+        try:
+            await polling
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if on_shutdown:
+                await on_shutdown()
+
+    asyncio.run(main())